@@ -0,0 +1,204 @@
+import gzip
+import math
+import os
+import re
+import shutil
+from array import array
+
+import numpy as np
+from lxml import etree
+
+from post import original_file_suffix
+from tcxparser import TAG_TRACK, TAG_TRACKPOINT, read_trackpoint, _ns, _release, _start_tag, _strip_declarations
+from thumbnail import simplify
+from utility import debug, warn
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+TAG_EXTENSIONS = _ns + 'Extensions'
+
+# Trackpoints closer than this to the route of the kept trackpoints are dropped, altitude included
+DEFAULT_TOLERANCE__M = 2.0
+
+# At least one trackpoint is kept in every interval of this length, so heart rate, cadence etc. keep their course
+# also on a straight and even road
+MAX_GAP__S = 10
+
+# Precompressed variants next to the attachment, which a web server can deliver as they are
+GZIP_SUFFIX = ".gz"
+BROTLI_SUFFIX = ".br"
+
+EARTH_RADIUS__M = 6371000
+
+_brotli_warned = False
+
+
+def _keep_trackpoints(times, altitudes, latitudes, longitudes, tolerance__m):
+    """
+    Select the trackpoints of a Track which change its route or altitude or are needed to close a time gap
+    :param times: numpy array with the UTC timestamps, NaN for missing values
+    :param altitudes: numpy array with the altitudes in m, NaN for missing values
+    :param latitudes: numpy array with the latitudes, NaN for trackpoints without position
+    :param longitudes: numpy array with the longitudes, NaN for trackpoints without position
+    :param tolerance__m: Maximum distance of a dropped trackpoint to the route
+    :return: numpy array with a bool per trackpoint
+    """
+    positioned = ~np.isnan(latitudes)
+    if positioned.sum() < 3:
+        return np.ones(len(times), dtype=bool)
+
+    # Trackpoints without position (e.g. indoor or lost signal) are kept, the runs in between are simplified
+    keep = ~positioned
+    latitude = math.radians(np.nanmean(latitudes))
+    measured = ~np.isnan(altitudes)
+    if measured.any():
+        indices = np.arange(len(altitudes))
+        altitudes = np.interp(indices, indices[measured], altitudes[measured])
+    else:
+        altitudes = np.zeros(len(altitudes))
+
+    edges = np.diff(np.concatenate(([0], positioned.astype(np.int8), [0])))
+    for start, end in zip(np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]):
+        ys = np.radians(latitudes[start:end]) * EARTH_RADIUS__M
+        xs = np.radians(longitudes[start:end]) * EARTH_RADIUS__M * math.cos(latitude)
+        keep[start + simplify(xs, ys, tolerance__m, altitudes[start:end])] = True
+
+    # The first trackpoint of every interval, trackpoints without time are kept
+    intervals = np.floor((times - np.nanmin(times)) / MAX_GAP__S) if not np.isnan(times).all() else times
+    keep[np.concatenate(([True], intervals[1:] != intervals[:-1]))] = True
+
+    return keep
+
+
+def _select_trackpoints(tcx_file, tolerance__m):
+    """
+    First pass of thin_tcx(): Decide for every trackpoint, whether it is kept
+    :param tcx_file: Path of the file
+    :param tolerance__m: Maximum distance of a dropped trackpoint to the route
+    :return: array with a bool per Trackpoint of the file in document order
+    """
+    ret = array('b')
+    columns = [array('d') for _ in range(4)]
+    for event, elem in etree.iterparse(tcx_file, tag=(TAG_TRACK, TAG_TRACKPOINT), huge_tree=True):
+        if elem.tag == TAG_TRACKPOINT:
+            (time, heart_rate, altitude, distance, latitude, longitude, cadence) = read_trackpoint(elem)
+            for column, value in zip(columns, (time, altitude, latitude, longitude)):
+                column.append(value)
+        else:
+            values = [np.frombuffer(column, dtype=float) for column in columns]
+            ret.extend(_keep_trackpoints(*values, tolerance__m).astype(np.int8).tobytes())
+            columns = [array('d') for _ in range(4)]
+        _release(elem)
+
+    return ret
+
+
+def thin_tcx(tcx_file, tolerance__m, target_file):
+    """
+    Size-optimised copy of a TCX file: Without whitespace, extensions of the trackpoints and trackpoints within
+    the tolerance of the route, see _keep_trackpoints(). Laps, summaries and the values of the kept trackpoints
+    are unchanged. Both files are streamed in two passes, only the elements being read are kept.
+    :param tcx_file: Path of the file
+    :param tolerance__m: Maximum distance of a dropped trackpoint to the route
+    :param target_file: Path of the thinned file
+    """
+    keep = _select_trackpoints(tcx_file, tolerance__m)
+
+    number = 0
+    # Namespace declarations of the root, not repeated in the elements
+    declarations = []
+    # Elements being read with the end tag, if their start tag has been written
+    opened = []
+    with open(target_file, "wb") as f:
+        f.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+        for event, elem in etree.iterparse(tcx_file, events=('start', 'end'), remove_blank_text=True,
+                                           remove_comments=True, huge_tree=True):
+            parent = elem.getparent()
+            # Trackpoints are written or dropped as a whole, None marks the elements within
+            if parent is not None and (parent.tag == TAG_TRACKPOINT or opened[-1] is None):
+                if event == 'start':
+                    opened.append(None)
+                else:
+                    opened.pop()
+                continue
+
+            if event == 'start':
+                if parent is None:
+                    (start, end) = _start_tag(elem, [])
+                    declarations = re.findall(rb' xmlns(?::[\w.-]+)?="[^"]*"', start)
+                    f.write(start)
+                    opened.append(end)
+                    continue
+
+                # The start tag of an element is written with its first child
+                if opened[-1] == b"":
+                    (start, end) = _start_tag(parent, declarations)
+                    f.write(start)
+                    opened[-1] = end
+                opened.append(b"")
+                continue
+
+            end = opened.pop()
+            if len(end) > 0:
+                f.write(end)
+            elif elem.tag == TAG_TRACKPOINT:
+                if keep[number]:
+                    for extensions in elem.findall(TAG_EXTENSIONS):
+                        elem.remove(extensions)
+                    f.write(_strip_declarations(etree.tostring(elem, with_tail=False), declarations))
+                number += 1
+            else:
+                f.write(_strip_declarations(etree.tostring(elem, with_tail=False), declarations))
+
+            if parent is not None:
+                _release(elem)
+
+    debug(f"Thinned {os.path.basename(tcx_file)} from {len(keep)} to {sum(keep)} trackpoints")
+
+
+def write_lean_attachment(post, activity_file, tolerance__m):
+    """
+    Replace the post's activity file by a thinned one with precompressed variants. The original is kept as
+    full-fidelity source for deriving the post, but is not published, see ignoreFiles in config.toml.
+    :param post: Post
+    :param activity_file: Path of the post's original activity file, see Post.get_activity_file()
+    :param tolerance__m: Maximum distance of a dropped trackpoint to the route
+    """
+    global _brotli_warned
+
+    attachment = os.path.join(os.path.dirname(post.file_name), post.data[post.ACTIVITY])
+    original = f"{attachment}{original_file_suffix}"
+    if not os.path.exists(original) or not os.path.samefile(activity_file, original):
+        # Keeps the modification time, so the track cache stays fresh
+        shutil.copy2(activity_file, original)
+
+    # Written next to the attachment and renamed, so an interrupted run doesn't leave a truncated file
+    thinned = f"{attachment}.tmp"
+    thin_tcx(original, tolerance__m, thinned)
+
+    variants = [f"{attachment}{GZIP_SUFFIX}"]
+    with open(thinned, "rb") as source, open(f"{variants[0]}.tmp", "wb") as target:
+        # Without name and time in the header, so equal attachments get equal variants
+        with gzip.GzipFile("", "wb", 9, target, mtime=0) as compressed:
+            shutil.copyfileobj(source, compressed, 1 << 20)
+
+    if brotli is not None:
+        variants.append(f"{attachment}{BROTLI_SUFFIX}")
+        with open(thinned, "rb") as source, open(f"{variants[1]}.tmp", "wb") as target:
+            compressor = brotli.Compressor(quality=11)
+            for chunk in iter(lambda: source.read(1 << 20), b""):
+                target.write(compressor.process(chunk))
+            target.write(compressor.finish())
+    elif not _brotli_warned:
+        warn("Python package 'brotli' not installed, attachments are precompressed with gzip only")
+        _brotli_warned = True
+
+    for file in variants:
+        os.replace(f"{file}.tmp", file)
+    os.replace(thinned, attachment)
+
+    debug(f"Lean attachment {os.path.basename(attachment)}: {os.path.getsize(original)} bytes original, "
+          + ", ".join(f"{os.path.getsize(file)} {os.path.basename(file)}" for file in [attachment] + variants))
@@ -0,0 +1,205 @@
+import json
+import os
+
+import numpy as np
+
+from fingerprint import geohash
+from post import Post, list_post_files, read_post_file
+from utility import debug, data_dir, posts_dir
+
+climbs_file = os.path.join(data_dir, "climbs.json")
+
+# The altitude is resampled in steps of STEP__M and smoothed with a moving average over SMOOTHING__M
+STEP__M = 20
+SMOOTHING__M = 200
+
+# A step is rising above this gradient. Rising runs are merged, if they are separated by a gap
+# not longer than MAX_GAP__M and losing not more than MAX_GAP_LOSS__M.
+MIN_GRADIENT = 0.01
+MAX_GAP__M = 200
+MAX_GAP_LOSS__M = 10
+
+# A climb needs this length and average gradient. Its score is length in m times average gradient in %,
+# categories by minimum score. Climbs scoring below the lowest category are kept as uncategorised, so they can be
+# compared as well.
+MIN_LENGTH__M = 500
+MIN_AVERAGE_GRADIENT = 0.03
+CATEGORIES = [(8000, '4'), (16000, '3'), (32000, '2'), (64000, '1'), (80000, 'HC')]
+UNCATEGORISED = 'uncategorised'
+
+# Start and end of a climb are identified by geohash cells (6 is about 1.2 x 0.6 km)
+SEGMENT_PRECISION = 6
+
+
+def _category(score):
+    ret = UNCATEGORISED
+    for limit, category in CATEGORIES:
+        if score >= limit:
+            ret = category
+
+    return ret
+
+
+def _moving_average(values, window):
+    padded = np.pad(values, (window // 2, window - 1 - window // 2), mode='edge')
+    return np.convolve(padded, np.ones(window) / window, mode='valid')
+
+
+def detect_climbs(tcxparser):
+    """
+    Smooth the altitude against distance and split the profile into climbs, categorised by their score
+    :param tcxparser: TCXParser
+    :return: List with a dict per climb, ordered by distance
+    """
+    track = tcxparser.track()
+    valid = ~np.isnan(track['altitude']) & ~np.isnan(track['distance']) & ~np.isnan(track['time'])
+    if valid.sum() < 2:
+        return []
+
+    distances = np.maximum.accumulate(track['distance'][valid])
+    times = track['time'][valid]
+    grid = np.arange(distances[0], distances[-1], STEP__M)
+    window = SMOOTHING__M // STEP__M
+    if len(grid) <= window:
+        return []
+
+    elevation = _moving_average(np.interp(grid, distances, track['altitude'][valid]), window)
+    gradients = np.diff(elevation) / STEP__M
+
+    # Runs of rising steps: climb from elevation[start] to elevation[end]
+    edges = np.diff(np.concatenate(([0], (gradients > MIN_GRADIENT).astype(np.int8), [0])))
+    runs = []
+    for start, end in zip(np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]):
+        if len(runs) > 0 and (start - runs[-1][1]) * STEP__M <= MAX_GAP__M \
+                and elevation[runs[-1][1]] - elevation[start] <= MAX_GAP_LOSS__M:
+            runs[-1][1] = end
+        else:
+            runs.append([start, end])
+
+    positioned = valid & ~np.isnan(track['latitude'])
+    position_distances = np.maximum.accumulate(track['distance'][positioned]) if positioned.any() else None
+
+    ret = []
+    for start, end in runs:
+        length = int(end - start) * STEP__M
+        gain = float(elevation[end] - elevation[start])
+        average_gradient = gain / length
+        if length < MIN_LENGTH__M or average_gradient < MIN_AVERAGE_GRADIENT:
+            continue
+
+        climb = {
+            'start__m': int(grid[start]),
+            'length__m': int(length),
+            'gain__m': int(round(gain)),
+            'average_gradient__pct': round(average_gradient * 100, 1),
+            'maximum_gradient__pct': round(float(gradients[start:end].max()) * 100, 1),
+            'category': _category(length * average_gradient * 100),
+            'time__s': int(round(np.interp(grid[end], distances, times) - np.interp(grid[start], distances, times))),
+        }
+
+        if position_distances is not None:
+            cells = [geohash(float(np.interp(grid[i], position_distances, track['latitude'][positioned])),
+                             float(np.interp(grid[i], position_distances, track['longitude'][positioned])),
+                             SEGMENT_PRECISION)
+                     for i in (start, end)]
+            climb['segment'] = "-".join(cells)
+
+        ret.append(climb)
+
+    return ret
+
+
+def set_climbs(post, tcxparser):
+    """
+    Set or remove the climbs in the post
+    :param post: Post
+    :param tcxparser: TCXParser of the post's activity
+    :return: True, if the post data changed
+    """
+    climbs = detect_climbs(tcxparser)
+    old = post.data.get(Post.CLIMBS)
+
+    if len(climbs) > 0:
+        post.data[Post.CLIMBS] = climbs
+    elif Post.CLIMBS in post.data:
+        post.data.pop(Post.CLIMBS)
+
+    return old != post.data.get(Post.CLIMBS)
+
+
+class ClimbIndex:
+    """
+    Climbs of all posts by segment (start and end cell), so repeated climbs can be compared
+    """
+
+    def __init__(self, climbs):
+        # Dict segment -> dict with the climb's data and 'efforts', fastest first
+        self.climbs = climbs
+        # Dict post key -> set of the segments with efforts of the post, so a post's efforts are found directly
+        self.posts = dict()
+        for segment, entry in climbs.items():
+            for effort in entry['efforts']:
+                self.posts.setdefault(effort['post'], set()).add(segment)
+
+    def remove_post(self, post_key):
+        for segment in self.posts.pop(post_key, set()):
+            efforts = [e for e in self.climbs[segment]['efforts'] if e['post'] != post_key]
+            if len(efforts) == 0:
+                self.climbs.pop(segment)
+            else:
+                self.climbs[segment]['efforts'] = efforts
+
+    def add_post(self, post):
+        """
+        Add the climbs of a post. Efforts of an earlier version of the post will be replaced.
+        :param post: Post
+        """
+        self.remove_post(post.get_dir())
+
+        for climb in post.data.get(Post.CLIMBS, []):
+            if 'segment' not in climb:
+                continue
+
+            entry = self.climbs.setdefault(climb['segment'], {'efforts': []})
+            self.posts.setdefault(post.get_dir(), set()).add(climb['segment'])
+            for key in ('length__m', 'gain__m', 'average_gradient__pct', 'category'):
+                entry[key] = climb[key]
+
+            entry['efforts'].append({
+                'post': post.get_dir(),
+                'path': "post/" + os.path.relpath(os.path.dirname(post.file_name), posts_dir),
+                'title': post.data.get(Post.TITLE, ""),
+                'date': post.get_date(),
+                'time__s': climb['time__s'],
+            })
+            entry['efforts'].sort(key=lambda e: (e['time__s'], e['post']))
+
+    def save(self):
+        debug(f"Saving {len(self.climbs)} climbs to {climbs_file}")
+        os.makedirs(data_dir, exist_ok=True)
+        with open(climbs_file, "w") as f:
+            json.dump(self.climbs, f, indent=2, sort_keys=True)
+
+
+def read_climb_index():
+    """
+    Read the climb index
+    :return: ClimbIndex, empty if there is none
+    """
+    if not os.path.exists(climbs_file):
+        return ClimbIndex(dict())
+
+    with open(climbs_file, "r") as f:
+        return ClimbIndex(json.load(f))
+
+
+def build_climb_index():
+    """
+    Build the climb index from the climbs of all posts, e.g. after posts have been deleted
+    :return: ClimbIndex
+    """
+    index = ClimbIndex(dict())
+    for post_file in list_post_files():
+        index.add_post(read_post_file(post_file))
+
+    return index
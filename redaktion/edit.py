@@ -0,0 +1,117 @@
+import argparse
+import copy
+import datetime
+
+import toml
+
+from post import Post, list_post_files, read_post_file, diff_data
+
+
+def parse_assignment(text):
+    """
+    Parse a set argument
+    :param text: String "KEY=VALUE", the value in TOML like in index.md, e.g. "draft=false" or
+    'topic="pendel"'. A value which is no valid TOML is taken as string, e.g. "topic=pendel".
+    :return: Tuple (key, value)
+    """
+    if "=" not in text or len(text.split("=", 1)[0].strip()) == 0:
+        raise argparse.ArgumentTypeError(f"Invalid assignment '{text}', expected KEY=VALUE, e.g. draft=false")
+
+    (key, value) = [v.strip() for v in text.split("=", 1)]
+    try:
+        return key, toml.loads(f"value = {value}")['value']
+    except toml.TomlDecodeError:
+        return key, value
+
+
+def parse_rename(text):
+    """
+    Parse a rename argument
+    :param text: String "OLD=NEW" with the keys, e.g. "material=device"
+    :return: Tuple (old key, new key)
+    """
+    (old, new) = [v.strip() for v in text.split("=", 1)] if "=" in text else ("", "")
+    if len(old) == 0 or len(new) == 0:
+        raise argparse.ArgumentTypeError(f"Invalid rename '{text}', expected OLD=NEW, e.g. material=device")
+
+    return old, new
+
+
+def parse_date(text):
+    """
+    :param text: String "YYYY-MM-DD"
+    :return: datetime.date
+    """
+    try:
+        return datetime.datetime.strptime(text, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid date '{text}', expected YYYY-MM-DD, e.g. 2020-12-31")
+
+
+def matches(post, year=None, category=None, topic=None, device=None, date_from=None, date_to=None):
+    """
+    Predicate over the front matter. Values which are None match any post.
+    :param post: Post
+    :param year: String, e.g. "2020"
+    :param category: String, e.g. "cycling"
+    :param topic: String, e.g. "pendel"
+    :param device: String, e.g. "votec-vrx-pro"
+    :param date_from: datetime.date of the first day
+    :param date_to: datetime.date of the last day
+    :return: True, if the post matches all given values
+    """
+    for (key, value) in ((Post.YEAR, year), (Post.CATEGORY, category), (Post.TOPIC, topic), (Post.DEVICE, device)):
+        if value is not None and str(post.data.get(key, "")) != value:
+            return False
+
+    if date_from is None and date_to is None:
+        return True
+
+    date = post.get_datetime().date()
+    return (date_from is None or date >= date_from) and (date_to is None or date <= date_to)
+
+
+def edit_post(post, assignments, unsets, renames):
+    """
+    Change the post data: first rename, then unset, then set the keys
+    :param post: Post
+    :param assignments: List with tuples (key, value)
+    :param unsets: List with keys
+    :param renames: List with tuples (old key, new key)
+    """
+    for (old, new) in renames:
+        if old in post.data:
+            post.data[new] = post.data.pop(old)
+
+    for key in unsets:
+        post.data.pop(key, None)
+
+    for (key, value) in assignments:
+        post.data[key] = value
+
+
+def plan_edit(selection, assignments, unsets, renames):
+    """
+    Edit all selected posts in memory
+    :param selection: Dict with the arguments of matches(), e.g. {'year': "2020"}
+    :param assignments: List with tuples (key, value)
+    :param unsets: List with keys
+    :param renames: List with tuples (old key, new key)
+    :return: Tuple (list with tuples (post, changes) of the posts whose data changes, see diff_data(),
+    number of selected posts)
+    """
+    changed = []
+    selected = 0
+    for post_file in list_post_files():
+        post = read_post_file(post_file)
+        if not matches(post, **selection):
+            continue
+
+        selected += 1
+        old = copy.deepcopy(post.data)
+        edit_post(post, assignments, unsets, renames)
+        changes = diff_data(old, post.data)
+        if len(changes) > 0:
+            changed.append((post, changes))
+
+    return changed, selected
@@ -0,0 +1,185 @@
+import json
+import os
+
+from post import list_post_files, read_post_file
+from trackcache import open_activity
+from utility import debug, out, warn, index_dir, convert_z_ended_date_to_dt
+
+fingerprint_file = os.path.join(index_dir, "fingerprints.json")
+
+# Activities starting within this time are compared, in seconds. Also the width of an index bucket.
+START_TOLERANCE__S = 15 * 60
+DURATION_TOLERANCE__S = 5 * 60
+DURATION_TOLERANCE_RATIO = 0.1
+DISTANCE_TOLERANCE__M = 200
+DISTANCE_TOLERANCE_RATIO = 0.05
+
+# Downsampled track: number of samples and geohash precision (6 is a cell of about 1.2 x 0.6 km)
+TRACK_SAMPLES = 16
+GEOHASH_PRECISION = 6
+MIN_TRACK_OVERLAP = 0.7
+
+_base32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash(latitude, longitude, precision):
+    """
+    Encode a position as geohash
+    :param latitude: float
+    :param longitude: float
+    :param precision: Number of characters
+    :return: String, e.g. "u0yjjd"
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    ret = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(ret) < precision:
+        if even:
+            value, interval = longitude, lon_range
+        else:
+            value, interval = latitude, lat_range
+        mid = (interval[0] + interval[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            interval[0] = mid
+        else:
+            interval[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            ret.append(_base32[bits])
+            bits = 0
+            bit_count = 0
+
+    return "".join(ret)
+
+
+def build_fingerprint(tcxparser):
+    """
+    Fingerprint of an activity: start time (in minutes), duration, distance and the downsampled track
+    as sequence of geohash cells
+    :param tcxparser: TCXParser
+    :return: dict
+    """
+    latitudes = tcxparser.latitude_values()
+    longitudes = tcxparser.longitude_values()
+    cells = []
+    if len(latitudes) > 0:
+        samples = min(TRACK_SAMPLES, len(latitudes))
+        for k in range(samples):
+            i = k * (len(latitudes) - 1) // max(samples - 1, 1)
+            cells.append(geohash(latitudes[i], longitudes[i], GEOHASH_PRECISION))
+
+    return {
+        'start': int(convert_z_ended_date_to_dt(tcxparser.started_at).timestamp()) // 60,
+        'duration': int(tcxparser.duration),
+        'distance': int(tcxparser.distance),
+        'cells': cells,
+    }
+
+
+def _within(a, b, absolute, ratio):
+    return abs(a - b) <= max(absolute, ratio * max(a, b))
+
+
+def is_same_activity(a, b):
+    """
+    Compare two fingerprints
+    :param a: Fingerprint dict
+    :param b: Fingerprint dict
+    :return: True, if both fingerprints describe the same activity
+    """
+    if abs(a['start'] - b['start']) * 60 > START_TOLERANCE__S:
+        return False
+
+    if not _within(a['duration'], b['duration'], DURATION_TOLERANCE__S, DURATION_TOLERANCE_RATIO):
+        return False
+
+    if not _within(a['distance'], b['distance'], DISTANCE_TOLERANCE__M, DISTANCE_TOLERANCE_RATIO):
+        return False
+
+    if len(a['cells']) == 0 or len(b['cells']) == 0:
+        return len(a['cells']) == len(b['cells'])
+
+    b_cells = set(b['cells'])
+    overlap = sum(1 for c in a['cells'] if c in b_cells) / len(a['cells'])
+    return overlap >= MIN_TRACK_OVERLAP
+
+
+def _bucket(fingerprint):
+    return fingerprint['start'] * 60 // START_TOLERANCE__S
+
+
+class FingerprintIndex:
+    """
+    Fingerprints of all posts, bucketed by start time. A lookup only compares the fingerprints of the
+    neighbouring buckets, so it takes roughly constant time regardless of the number of posts.
+    """
+
+    def __init__(self, fingerprints):
+        # Fingerprint dict by post key, e.g. "20201231-172153"
+        self.fingerprints = fingerprints
+        self.buckets = dict()
+        for key, fingerprint in fingerprints.items():
+            self.buckets.setdefault(_bucket(fingerprint), set()).add(key)
+
+    def add(self, post_key, fingerprint):
+        self.remove(post_key)
+        self.fingerprints[post_key] = fingerprint
+        self.buckets.setdefault(_bucket(fingerprint), set()).add(post_key)
+
+    def remove(self, post_key):
+        if post_key in self.fingerprints:
+            self.buckets[_bucket(self.fingerprints.pop(post_key))].discard(post_key)
+
+    def find_duplicate(self, fingerprint, ignore_key=None):
+        """
+        Find a post with the same activity
+        :param fingerprint: Fingerprint dict of the new activity
+        :param ignore_key: Post key to skip, e.g. the post to be overwritten
+        :return: Post key of the duplicate or None
+        """
+        bucket = _bucket(fingerprint)
+        for b in (bucket, bucket - 1, bucket + 1):
+            for key in sorted(self.buckets.get(b, ())):
+                if key != ignore_key and is_same_activity(fingerprint, self.fingerprints[key]):
+                    return key
+
+        return None
+
+    def save(self):
+        debug(f"Saving {len(self.fingerprints)} fingerprints to {fingerprint_file}")
+        os.makedirs(index_dir, exist_ok=True)
+        with open(fingerprint_file, "w") as f:
+            json.dump(self.fingerprints, f, sort_keys=True)
+
+
+def read_fingerprint_index():
+    """
+    Read the persisted index. If there is none, it will be built once from the activity files of all
+    existing posts
+    :return: FingerprintIndex
+    """
+    if os.path.exists(fingerprint_file):
+        with open(fingerprint_file, "r") as f:
+            return FingerprintIndex(json.load(f))
+
+    index = FingerprintIndex(dict())
+    post_files = list_post_files()
+    if len(post_files) > 0:
+        out(f"Building fingerprint index for {len(post_files)} existing posts...")
+
+    for post_file in post_files:
+        post = read_post_file(post_file)
+        tcxparser = open_activity(post, stream=True)
+        if tcxparser is None:
+            warn(f"No activity file for {post.get_dir()}, no fingerprint")
+            continue
+
+        index.add(post.get_dir(), build_fingerprint(tcxparser))
+
+    return index
@@ -0,0 +1,216 @@
+import datetime
+import json
+import math
+import os
+
+import numpy as np
+
+from post import Post, list_post_files, read_post_file
+from utility import debug, warn, data_dir, index_dir
+
+fitness_file = os.path.join(data_dir, "fitness.json")
+checkpoint_file = os.path.join(index_dir, "fitness.json")
+
+# Heart rate reserve for Banister's TRIMP
+HR_REST__BPM = 50
+HR_MAX__BPM = 190
+# Gaps between trackpoints are counted with this maximum, so pauses don't add training load
+MAX_SAMPLE_GAP__S = 60
+
+# Time constants in days of the exponentially weighted fitness (CTL) and fatigue (ATL)
+FITNESS_DAYS = 42
+FATIGUE_DAYS = 7
+
+
+def trimp(tcxparser):
+    """
+    Banister's training impulse from the heart rate series
+    :param tcxparser: TCXParser
+    :return: TRIMP as float or None, if the activity has no heart rate
+    """
+    track = tcxparser.track()
+    valid = ~np.isnan(track['time']) & ~np.isnan(track['heart_rate'])
+    if valid.sum() < 2:
+        return None
+
+    minutes = np.clip(np.diff(track['time'][valid]), 0, MAX_SAMPLE_GAP__S) / 60
+    reserve = np.clip((track['heart_rate'][valid][1:] - HR_REST__BPM) / (HR_MAX__BPM - HR_REST__BPM), 0, 1)
+
+    return float(np.sum(minutes * reserve * 0.64 * np.exp(1.92 * reserve)))
+
+
+def set_trimp(post, tcxparser):
+    """
+    Set or remove the TRIMP in the post
+    :param post: Post
+    :param tcxparser: TCXParser of the post's activity
+    :return: True, if the post data changed
+    """
+    value = trimp(tcxparser)
+    old = post.data.get(Post.TRIMP)
+
+    if value is not None:
+        post.data[Post.TRIMP] = round(value, 1)
+    elif Post.TRIMP in post.data:
+        post.data.pop(Post.TRIMP)
+
+    return old != post.data.get(Post.TRIMP)
+
+
+def _to_date(text):
+    return datetime.datetime.strptime(text, "%Y-%m-%d").date()
+
+
+class Fitness:
+    """
+    Daily training load with fitness (CTL), fatigue (ATL) and form (TSB) over all posts. The series is the
+    checkpoint of the recurrence: a change only recomputes the days from the earliest changed activity on.
+    """
+
+    def __init__(self, activities, series):
+        # Dict post key -> {'date': "2020-12-31", 'load': TRIMP}
+        self.activities = activities
+        # List with a dict per day, oldest first, see update()
+        self.series = series
+        # Earliest date (datetime.date) to recompute or None
+        self.changed_from = None
+
+    def _changed(self, date):
+        if self.changed_from is None or date < self.changed_from:
+            self.changed_from = date
+
+    def remove_post(self, post_key):
+        if post_key in self.activities:
+            self._changed(_to_date(self.activities.pop(post_key)['date']))
+
+    def add_post(self, post):
+        """
+        Add the training load of a post. An earlier version of the post will be replaced.
+        :param post: Post
+        """
+        post_key = post.get_dir()
+        load = post.data.get(Post.TRIMP)
+        activity = {'date': post.get_datetime().strftime("%Y-%m-%d"), 'load': load}
+
+        if self.activities.get(post_key) == activity or (load is None and post_key not in self.activities):
+            return
+
+        self.remove_post(post_key)
+        if load is not None:
+            self.activities[post_key] = activity
+            self._changed(_to_date(activity['date']))
+
+    def update(self):
+        """
+        Advance the recurrence from the last checkpoint before the earliest change
+        :return: Number of recomputed days
+        """
+        if self.changed_from is None:
+            return 0
+
+        daily = dict()
+        for activity in self.activities.values():
+            date = _to_date(activity['date'])
+            if date >= self.changed_from:
+                daily[date] = daily.get(date, 0.0) + activity['load']
+
+        start = self.changed_from
+        fitness = fatigue = 0.0
+        if len(self.series) > 0:
+            first = _to_date(self.series[0]['date'])
+            if start > first:
+                kept = min((start - first).days, len(self.series))
+                del self.series[kept:]
+                fitness = self.series[-1]['fitness']
+                fatigue = self.series[-1]['fatigue']
+                start = first + datetime.timedelta(days=kept)
+            else:
+                self.series = []
+
+        if len(self.activities) == 0:
+            self.series = []
+            self.changed_from = None
+            return 0
+
+        end = max(_to_date(a['date']) for a in self.activities.values())
+        if len(self.series) == 0:
+            start = min(_to_date(a['date']) for a in self.activities.values())
+
+        fitness_decay = 1 - math.exp(-1 / FITNESS_DAYS)
+        fatigue_decay = 1 - math.exp(-1 / FATIGUE_DAYS)
+        days = 0
+        date = start
+        while date <= end:
+            load = daily.get(date, 0.0)
+            form = fitness - fatigue
+            fitness += (load - fitness) * fitness_decay
+            fatigue += (load - fatigue) * fatigue_decay
+            # Fitness and fatigue are not rounded, they are the state to continue from
+            self.series.append({
+                'date': date.strftime("%Y-%m-%d"),
+                'load': round(load, 1),
+                'fitness': fitness,
+                'fatigue': fatigue,
+                'form': round(form, 2),
+            })
+            date += datetime.timedelta(days=1)
+            days += 1
+
+        # Series ends with the last activity
+        del self.series[(end - _to_date(self.series[0]['date'])).days + 1:]
+        self.changed_from = None
+        debug(f"Fitness recomputed for {days} days")
+
+        return days
+
+    def save(self):
+        self.update()
+
+        os.makedirs(index_dir, exist_ok=True)
+        with open(checkpoint_file, "w") as f:
+            json.dump(self.activities, f, sort_keys=True)
+
+        os.makedirs(data_dir, exist_ok=True)
+        with open(fitness_file, "w") as f:
+            json.dump(self.series, f, indent=1)
+
+
+def read_fitness():
+    """
+    Read the training load checkpoint and series
+    :return: Fitness, empty if there is none
+    """
+    if not os.path.exists(checkpoint_file) or not os.path.exists(fitness_file):
+        return Fitness(dict(), [])
+
+    with open(checkpoint_file, "r") as f:
+        activities = json.load(f)
+
+    with open(fitness_file, "r") as f:
+        series = json.load(f)
+
+    return Fitness(activities, series)
+
+
+def sync_fitness(fitness):
+    """
+    Add posts missing in the training load and remove deleted ones. Only the front matter is read.
+    :param fitness: Fitness
+    :return: Number of posts without TRIMP
+    """
+    missing = 0
+    keys = set()
+    for post_file in list_post_files():
+        post = read_post_file(post_file)
+        keys.add(post.get_dir())
+        if Post.TRIMP not in post.data:
+            missing += 1
+        fitness.add_post(post)
+
+    for post_key in [k for k in fitness.activities if k not in keys]:
+        fitness.remove_post(post_key)
+
+    if missing > 0:
+        warn(f"{missing} posts without TRIMP, e.g. without heart rate or created before. Try 'rebuild'.")
+
+    return missing
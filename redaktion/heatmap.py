@@ -0,0 +1,219 @@
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from post import list_post_files, read_post_file
+from trackcache import open_activity
+from utility import debug, out, warn, index_dir, static_dir, data_dir
+
+heatmap_file = os.path.join(index_dir, "heatmap.npz")
+heatmap_png_file = os.path.join(static_dir, "heatmap.png")
+heatmap_data_file = os.path.join(data_dir, "heatmap.json")
+
+# Grid cell size in degrees (about 110 m north-south) and cells per side of a tile
+RESOLUTION = 0.001
+TILE_SIZE = 256
+
+# Heat color ramp for the rendered image: RGB from cold to hot
+_cold = np.array([180, 30, 30], dtype=float)
+_hot = np.array([255, 230, 80], dtype=float)
+
+
+class Heatmap:
+    """
+    Trackpoint counts of all posts in a fixed-resolution lat/lon grid. Only tiles with trackpoints are stored.
+    """
+
+    def __init__(self, tiles, posts):
+        # uint32 arrays [lat, lon] by (tile_x, tile_y), tile_y counts from south to north
+        self.tiles = tiles
+        # Keys of the posts already binned, e.g. "20201231-172153"
+        self.posts = posts
+
+    def add(self, post_key, latitudes, longitudes):
+        """
+        Bin the trackpoints of a post. A post that has already been added is skipped.
+        :param post_key: e.g. "20201231-172153"
+        :param latitudes: Sequence with floats
+        :param longitudes: Sequence with floats, same length as latitudes
+        :return: True, if added
+        """
+        if post_key in self.posts:
+            debug(f"Heatmap contains {post_key} already")
+            return False
+
+        self.posts.add(post_key)
+        if len(latitudes) == 0:
+            return True
+
+        cell_y = np.floor((np.asarray(latitudes, dtype=float) + 90.0) / RESOLUTION).astype(np.int64)
+        cell_x = np.floor((np.asarray(longitudes, dtype=float) + 180.0) / RESOLUTION).astype(np.int64)
+        tile_x, local_x = np.divmod(cell_x, TILE_SIZE)
+        tile_y, local_y = np.divmod(cell_y, TILE_SIZE)
+        tile_ids = tile_x * (1 << 32) + tile_y
+
+        for tile_id in np.unique(tile_ids):
+            in_tile = tile_ids == tile_id
+            key = (int(tile_id >> 32), int(tile_id & 0xFFFFFFFF))
+            counts = np.bincount(local_y[in_tile] * TILE_SIZE + local_x[in_tile], minlength=TILE_SIZE * TILE_SIZE)
+            if key not in self.tiles:
+                self.tiles[key] = np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.uint32)
+            self.tiles[key] += counts.reshape(TILE_SIZE, TILE_SIZE).astype(np.uint32)
+
+        return True
+
+    def save(self):
+        debug(f"Saving heatmap with {len(self.tiles)} tiles to {heatmap_file}")
+        os.makedirs(index_dir, exist_ok=True)
+        arrays = {f"grid_{x}_{y}": grid for (x, y), grid in self.tiles.items()}
+        np.savez_compressed(heatmap_file, resolution=RESOLUTION, tile_size=TILE_SIZE,
+                            posts=np.array(sorted(self.posts), dtype=str), **arrays)
+
+    def grid(self, max_size):
+        """
+        Mosaic of all tiles, cropped to the cells with trackpoints and summed up in blocks of cells, so neither side
+        exceeds the maximum size. Every tile is binned into the blocks on its own, the full-resolution mosaic of
+        distant tiles (e.g. New York and Berlin) wouldn't fit into memory.
+        :param max_size: Maximum width and height in blocks
+        :return: Tuple with uint64 array (north at the top) and bounds (south, west, north, east) or None, if empty
+        """
+        # Nonzero cells per tile in global cell coordinates
+        cells = []
+        for (x, y), tile in self.tiles.items():
+            (local_y, local_x) = np.nonzero(tile)
+            if len(local_y) > 0:
+                cells.append((y * TILE_SIZE + local_y, x * TILE_SIZE + local_x, tile[local_y, local_x]))
+
+        if len(cells) == 0:
+            return None
+
+        min_row = min(int(rows.min()) for (rows, cols, counts) in cells)
+        max_row = max(int(rows.max()) for (rows, cols, counts) in cells)
+        min_col = min(int(cols.min()) for (rows, cols, counts) in cells)
+        max_col = max(int(cols.max()) for (rows, cols, counts) in cells)
+        height = max_row - min_row + 1
+        width = max_col - min_col + 1
+
+        factor = max(1, int(np.ceil(max(height, width) / max_size)))
+        mosaic = np.zeros((int(np.ceil(height / factor)), int(np.ceil(width / factor))), dtype=np.uint64)
+        for (rows, cols, counts) in cells:
+            np.add.at(mosaic, ((max_row - rows) // factor, (cols - min_col) // factor), counts)
+
+        south = min_row * RESOLUTION - 90.0
+        west = min_col * RESOLUTION - 180.0
+        north = south + height * RESOLUTION
+        east = west + width * RESOLUTION
+
+        return mosaic, (round(south, 6), round(west, 6), round(north, 6), round(east, 6))
+
+
+def read_heatmap():
+    """
+    Read the persisted heatmap
+    :return: Heatmap, empty if there is none or if it has been built with another resolution
+    """
+    if not os.path.exists(heatmap_file):
+        return Heatmap(dict(), set())
+
+    with np.load(heatmap_file) as f:
+        if float(f['resolution']) != RESOLUTION or int(f['tile_size']) != TILE_SIZE:
+            warn("Heatmap resolution changed, starting a new one")
+            return Heatmap(dict(), set())
+
+        tiles = dict()
+        for name in f.files:
+            if name.startswith("grid_"):
+                (x, y) = name.split("_")[1:]
+                tiles[(int(x), int(y))] = f[name]
+
+        return Heatmap(tiles, set(f['posts'].tolist()))
+
+
+def add_missing_posts(heatmap):
+    """
+    Bin all existing posts which are not in the heatmap yet
+    :param heatmap: Heatmap
+    :return: Number of added posts
+    """
+    added = 0
+    for post_file in list_post_files():
+        post = read_post_file(post_file)
+        if post.get_dir() in heatmap.posts:
+            continue
+
+        tcxparser = open_activity(post, stream=True)
+        if tcxparser is None:
+            warn(f"No activity file for {post.get_dir()}, not in heatmap")
+            continue
+
+        debug(f"Adding {post.get_dir()} to heatmap")
+        heatmap.add(post.get_dir(), tcxparser.latitude_values(), tcxparser.longitude_values())
+        added += 1
+
+    return added
+
+
+def write_heatmap_image(heatmap, max_size):
+    """
+    Render the heatmap as PNG into the static directory and its bounds as data file for the blog
+    :param heatmap: Heatmap
+    :param max_size: Maximum width and height of the image in pixels
+    :return: True, if written
+    """
+    ret = heatmap.grid(max_size)
+    if ret is None:
+        out("Heatmap is empty")
+        return False
+
+    (grid, bounds) = ret
+    # Log scale, so single tracks stay visible next to the daily commute
+    level = np.log1p(grid.astype(float))
+    level /= level.max()
+    rgba = np.zeros(grid.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = (_cold + (_hot - _cold) * level[..., None]).astype(np.uint8)
+    rgba[..., 3] = np.where(grid > 0, 96 + 159 * level, 0).astype(np.uint8)
+
+    os.makedirs(static_dir, exist_ok=True)
+    with open(heatmap_png_file, "wb") as f:
+        f.write(_encode_png(rgba))
+
+    os.makedirs(data_dir, exist_ok=True)
+    with open(heatmap_data_file, "w") as f:
+        json.dump({
+            'image': "/" + os.path.basename(heatmap_png_file),
+            'south': bounds[0],
+            'west': bounds[1],
+            'north': bounds[2],
+            'east': bounds[3],
+            'width': int(grid.shape[1]),
+            'height': int(grid.shape[0]),
+            'posts': len(heatmap.posts),
+        }, f, indent=2, sort_keys=True)
+
+    debug(f"Heatmap {grid.shape[1]}x{grid.shape[0]} written to {heatmap_png_file}")
+    return True
+
+
+def _encode_png(rgba):
+    """
+    Minimal PNG encoder
+    :param rgba: uint8 array [height, width, 4]
+    :return: bytes
+    """
+    (height, width) = rgba.shape[:2]
+    # Every scanline starts with filter type 0
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+        chunk(b"IDAT", zlib.compress(raw.tobytes(), 9)),
+        chunk(b"IEND", b""),
+    ])
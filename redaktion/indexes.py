@@ -0,0 +1,50 @@
+from climbs import ClimbIndex, read_climb_index
+from fitness import Fitness, read_fitness
+from odometer import Odometer, read_odometer
+from records import Records, read_records
+from spatial import SpatialIndex, read_spatial_index
+
+
+class PostIndexes:
+    """
+    The indexes built from the front matter of the posts: records, climbs, training load, spatial index and
+    odometer. A post is added to and the indexes are saved with all of them.
+    """
+
+    def __init__(self, records, climbs, fitness, spatial, odometer):
+        self.records = records
+        self.climbs = climbs
+        self.fitness = fitness
+        self.spatial = spatial
+        self.odometer = odometer
+
+    def _all(self):
+        return self.records, self.climbs, self.fitness, self.spatial, self.odometer
+
+    def add_post(self, post):
+        """
+        Add a post to all indexes. An earlier version of the post will be replaced.
+        :param post: Post
+        """
+        for index in self._all():
+            index.add_post(post)
+
+    def save(self):
+        for index in self._all():
+            index.save()
+
+
+def read_post_indexes():
+    """
+    Read all persisted indexes
+    :return: PostIndexes
+    """
+    return PostIndexes(read_records(), read_climb_index(), read_fitness(), read_spatial_index(), read_odometer())
+
+
+def empty_post_indexes():
+    """
+    :return: PostIndexes without posts, e.g. for a shard whose posts are indexed by the merge
+    """
+    return PostIndexes(Records(dict()), ClimbIndex(dict()), Fitness(dict(), []), SpatialIndex(dict()),
+                       Odometer(dict(), dict()))
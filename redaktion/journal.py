@@ -0,0 +1,184 @@
+import json
+import os
+import shutil
+
+from utility import debug, error, index_dir
+
+journal_file_name = "load.journal"
+staging_dir_name = "staging"
+
+# States of an activity file in a load run, in processing order
+PLANNED = 'planned'
+PARSED = 'parsed'
+WRITTEN = 'written'
+ATTACHED = 'attached'
+SIDECAR_APPLIED = 'sidecar-applied'
+DONE = 'done'
+SKIPPED = 'skipped'
+
+
+class Journal:
+    """
+    Write-ahead journal of a load run. Every state change of an activity file is appended and synced to disk
+    before the next step is executed, so an interrupted run can be resumed exactly where it stopped.
+    Posts are built in a staging directory and promoted to the content directory with a rename.
+    """
+
+    def __init__(self, options, entries, directory=index_dir):
+        # Options of the load run, e.g. {'force': False, ...}
+        self.options = options
+        # Dict with the latest state and data (e.g. 'key', 'post_dir') by activity file path
+        self.entries = entries
+        # Directory of the journal file and the staging directory, e.g. of a shard
+        self.directory = directory
+        self._file = open(os.path.join(directory, journal_file_name), "a")
+
+    def files(self):
+        return list(self.entries.keys())
+
+    def state(self, file):
+        return self.entries[file]['state']
+
+    def get(self, file, key):
+        return self.entries[file].get(key)
+
+    def set(self, file, state, **values):
+        """
+        Append a state change of an activity file
+        :param file: Activity file path
+        :param state: New state, e.g. PARSED
+        :param values: Additional data to keep for the file
+        """
+        entry = dict(file=file, state=state, **values)
+        self._append(entry)
+        self.entries[file].update(entry)
+
+    def _append(self, entry):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def staging_path(self, post_key):
+        """
+        Directory to build a post in
+        :param post_key: e.g. "20201231-172153"
+        :return: String with path
+        """
+        return os.path.join(self.directory, staging_dir_name, post_key)
+
+    def activity_path(self, file_name):
+        """
+        File to keep a single activity of a file with several activities in, until its post is built
+        :param file_name: File name of the post's activity file, e.g. "bulk-2.tcx"
+        :return: String with path
+        """
+        return os.path.join(self.directory, staging_dir_name, file_name)
+
+    def add(self, file, **values):
+        """
+        Plan an additional entry, if it is not planned yet, e.g. for a further activity of a file
+        :param file: Entry name, e.g. "bulk.tcx#2"
+        :param values: Additional data to keep for the entry, e.g. 'parent'
+        """
+        if file not in self.entries:
+            entry = dict(file=file, state=PLANNED, **values)
+            self._append(entry)
+            self.entries[file] = entry
+
+    def is_complete(self):
+        # The number of 'activities' is known when a file has been parsed completely
+        return all(e['state'] in (DONE, SKIPPED) and ('parent' in e or 'activities' in e)
+                   for e in self.entries.values())
+
+    def close(self):
+        """
+        Close the journal. A completed journal will be deleted together with the staging directory,
+        otherwise it is kept for a resume.
+        """
+        self._file.close()
+        if self.is_complete():
+            debug("Load run completed, removing journal")
+            os.remove(os.path.join(self.directory, journal_file_name))
+            shutil.rmtree(os.path.join(self.directory, staging_dir_name), ignore_errors=True)
+
+
+def start_journal(files, options, directory=index_dir):
+    """
+    Start a new load run. A journal and staging directory of a previous run will be discarded.
+    :param files: List with the activity files to load
+    :param options: Dict with the options of the run
+    :param directory: Directory of the journal, e.g. of a shard
+    :return: Journal
+    """
+    journal_file = os.path.join(directory, journal_file_name)
+    staging_dir = os.path.join(directory, staging_dir_name)
+    if os.path.exists(journal_file):
+        debug("Discarding journal of previous load run")
+        os.remove(journal_file)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+
+    journal = Journal(options, {f: dict(file=f, state=PLANNED) for f in files}, directory)
+    journal._append({'options': options})
+    for f in files:
+        journal._append(dict(file=f, state=PLANNED))
+
+    return journal
+
+
+def read_journal(directory=index_dir):
+    """
+    Read the journal of an interrupted load run
+    :param directory: Directory of the journal, e.g. of a shard
+    :return: Journal
+    """
+    journal_file = os.path.join(directory, journal_file_name)
+    if not os.path.exists(journal_file):
+        error("No interrupted load run found to resume")
+
+    options = None
+    entries = dict()
+    with open(journal_file, "r") as f:
+        text = f.read()
+
+    for line in text.splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # Torn last line of a crash
+            debug(f"Ignoring broken journal line: {line}")
+            continue
+
+        if 'options' in entry:
+            options = entry['options']
+        else:
+            entries.setdefault(entry['file'], dict()).update(entry)
+
+    if not text.endswith("\n"):
+        with open(journal_file, "a") as f:
+            f.write("\n")
+
+    os.makedirs(os.path.join(directory, staging_dir_name), exist_ok=True)
+
+    return Journal(options, entries, directory)
+
+
+def promote(post_staging_dir, post_dir):
+    """
+    Move a completely built post from the staging area to the content directory. An existing post will be
+    replaced.
+    :param post_staging_dir: Directory of the post in the staging area
+    :param post_dir: Target directory
+    """
+    os.makedirs(os.path.dirname(post_dir), exist_ok=True)
+
+    if os.path.exists(post_dir):
+        replaced = f"{post_staging_dir}.replaced"
+        shutil.rmtree(replaced, ignore_errors=True)
+        os.rename(post_dir, replaced)
+        os.rename(post_staging_dir, post_dir)
+        shutil.rmtree(replaced)
+    else:
+        os.rename(post_staging_dir, post_dir)
+
+    debug(f"Promoted {post_dir}")
@@ -0,0 +1,138 @@
+import json
+import os
+
+from post import Post, list_post_files, read_post_file
+from utility import debug, out, data_dir, index_dir
+
+odometer_file = os.path.join(data_dir, "odometer.json")
+usages_file = os.path.join(index_dir, "odometer.json")
+
+# Summed values of a device, integers so a correction subtracts exactly what has been added
+TOTALS = ('distance__m', 'time__s', 'ascent__m')
+
+
+def post_devices(post):
+    """
+    :param post: Post
+    :return: List with the device and the utensils of the post, e.g. ["votec-vrx-pro", "tacx-rolle"]
+    """
+    ret = []
+    utensils = post.data.get(Post.UTENSILS, "")
+    names = [post.data.get(Post.DEVICE, "")] + (utensils.split(",") if isinstance(utensils, str) else utensils)
+    for name in [n.strip() for n in names]:
+        if len(name) > 0 and name not in ret:
+            ret.append(name)
+
+    return ret
+
+
+def build_usage(post):
+    """
+    :param post: Post
+    :return: Dict with the post's 'devices', 'date' and its values to sum up
+    """
+    return {
+        'devices': post_devices(post),
+        'date': post.get_datetime().strftime("%Y-%m-%d"),
+        'distance__m': int(round(post.data.get(Post.DISTANCE__M, 0))),
+        'time__s': int(round(post.data.get(Post.TOTAL_TIME__S, 0))),
+        'ascent__m': int(round(post.data.get(Post.ASCENT__M, 0))),
+    }
+
+
+class Odometer:
+    """
+    Totals per device and utensil over all posts, e.g. for the wear of chains, tyres and shoes. A post is
+    added and removed as delta, so a change doesn't need a recount of all posts.
+    """
+
+    def __init__(self, usages, devices):
+        # Dict post key -> usage, see build_usage()
+        self.usages = usages
+        # Dict device -> {'count', 'distance__m', 'time__s', 'ascent__m', 'first', 'last'}
+        self.devices = devices
+
+    def remove_post(self, post_key):
+        usage = self.usages.pop(post_key, None)
+        if usage is None:
+            return
+
+        for device in usage['devices']:
+            totals = self.devices[device]
+            totals['count'] -= 1
+            if totals['count'] == 0:
+                self.devices.pop(device)
+                continue
+
+            for key in TOTALS:
+                totals[key] -= usage[key]
+
+            if usage['date'] in (totals['first'], totals['last']):
+                dates = [u['date'] for u in self.usages.values() if device in u['devices']]
+                totals['first'] = min(dates)
+                totals['last'] = max(dates)
+
+    def add_post(self, post):
+        """
+        Add the usage of a post. An earlier version of the post will be replaced.
+        :param post: Post
+        """
+        post_key = post.get_dir()
+        usage = build_usage(post)
+        if self.usages.get(post_key) == usage:
+            return
+
+        self.remove_post(post_key)
+        if len(usage['devices']) == 0:
+            return
+
+        self.usages[post_key] = usage
+        for device in usage['devices']:
+            totals = self.devices.setdefault(device, {'count': 0, 'distance__m': 0, 'time__s': 0, 'ascent__m': 0,
+                                                      'first': usage['date'], 'last': usage['date']})
+            totals['count'] += 1
+            for key in TOTALS:
+                totals[key] += usage[key]
+            totals['first'] = min(totals['first'], usage['date'])
+            totals['last'] = max(totals['last'], usage['date'])
+
+    def save(self):
+        debug(f"Saving {len(self.devices)} devices to {odometer_file}")
+        os.makedirs(index_dir, exist_ok=True)
+        with open(usages_file, "w") as f:
+            json.dump(self.usages, f, sort_keys=True)
+
+        os.makedirs(data_dir, exist_ok=True)
+        with open(odometer_file, "w") as f:
+            json.dump(self.devices, f, indent=2, sort_keys=True)
+
+
+def build_odometer():
+    """
+    Build the odometer from the front matter of all posts, e.g. after posts have been deleted
+    :return: Odometer
+    """
+    odometer = Odometer(dict(), dict())
+    for post_file in list_post_files():
+        odometer.add_post(read_post_file(post_file))
+
+    return odometer
+
+
+def read_odometer():
+    """
+    Read the persisted odometer. If there is none, it will be built once from all existing posts
+    :return: Odometer
+    """
+    if not os.path.exists(usages_file) or not os.path.exists(odometer_file):
+        if len(list_post_files()) > 0:
+            out("Building odometer for existing posts...")
+        return build_odometer()
+
+    with open(usages_file, "r") as f:
+        usages = json.load(f)
+
+    with open(odometer_file, "r") as f:
+        devices = json.load(f)
+
+    return Odometer(usages, devices)
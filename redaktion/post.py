@@ -2,10 +2,15 @@ import datetime
 import os
 import re
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 import toml
 
-from utility import debug, convert_z_ended_date_to_dt, z_date_to_locale_date, z_date_to_utc_date, devices_dir
+from utility import debug, convert_z_ended_date_to_dt, z_date_to_locale_date, z_date_to_utc_date, devices_dir, \
+    posts_dir, post_file_name
+
+# The original of a lean attachment is kept with this suffix, e.g. "activity.tcx.original"
+original_file_suffix = ".original"
 
 
 def read_devices():
@@ -22,6 +27,19 @@ def read_devices():
     return ret
 
 
+def list_post_files():
+    """
+    Find the index files of all existing posts
+    :return: Sorted list with paths of the posts' index.md
+    """
+    ret = []
+    for root, dirs, files in os.walk(posts_dir):
+        if post_file_name in files:
+            ret.append(os.path.join(root, post_file_name))
+
+    return sorted(ret)
+
+
 def read_toml_file(file):
     """
     Read file with toml formatted data
@@ -44,6 +62,18 @@ def read_toml_file(file):
         return toml.loads(data)
 
 
+def read_post_content(file):
+    """
+    Read the content below the front matter, e.g. a manually written text
+    :file: Path of the file as String
+    :return: String, empty if there is no content
+    """
+    with open(file, "r") as f:
+        parts = re.split("^\\+\\+\\+.*\n?", f.read(), maxsplit=2, flags=re.MULTILINE)
+
+    return parts[2] if len(parts) > 2 else ""
+
+
 def read_post_file(file):
     """
     Read pst file content from an existing file
@@ -52,7 +82,49 @@ def read_post_file(file):
     """
     data = read_toml_file(file)
 
-    return Post(file, data)
+    return Post(file, data, read_post_content(file))
+
+
+def diff_data(old, new):
+    """
+    :param old: Dictionary with the post data before
+    :param new: Dictionary with the post data after
+    :return: List with tuples (key, old value or None, new value or None) of the changed keys, sorted by key
+    """
+    return [(key, old.get(key), new.get(key)) for key in sorted(set(old) | set(new)) if old.get(key) != new.get(key)]
+
+
+def check_required(data):
+    """
+    Check the keys every post needs, e.g. to sort it into the indexes
+    :param data: Dictionary with the post data
+    :return: List with the problems as Strings, empty if the data is valid
+    """
+    problems = []
+    for key in (Post.DATE, Post.DATE_UTC, Post.TITLE):
+        value = data.get(key)
+        if value is None:
+            problems.append(f"{key} missing")
+        elif not isinstance(value, str):
+            problems.append(f"{key} {value} is no string, quote the value")
+        elif key != Post.TITLE:
+            try:
+                datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z")
+            except ValueError:
+                problems.append(f"{key} {value!r} is no date like \"2004-12-31T07:03:38+0100\"")
+
+    return problems
+
+
+def save_posts(posts, jobs):
+    """
+    Write posts in parallel
+    :param posts: List with Post objects
+    :param jobs: Number of parallel writes
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # list() raises the first failed write
+        list(executor.map(lambda post: post.save(), posts))
 
 
 class Post:
@@ -67,7 +139,9 @@ class Post:
     AVERAGE_HEART_RATE__BPM = 'average_heart_rate__bpm'
     AVERAGE_SPEED__KM_PER_H = 'average_speed__km_per_h'
     BASE = 'base'
+    BEST_EFFORTS = 'best_efforts'
     CATEGORY = 'category'
+    CLIMBS = 'climbs'
     DATE = 'date'
     DATE_UTC = 'date_utc'
     DESCENT__M = 'descent__m'
@@ -78,10 +152,13 @@ class Post:
     DRAFT = 'draft'
     MAXIMUM_HEART_RATE__BPM = 'maximum_heart_rate__bpm'
     PACE__S_PER_KM = 'pace__s_per_km'
+    ROUTE_BBOX = 'route_bbox'
     SPORT = 'sport'
+    START_POSITION = 'start_position'
     TITLE = 'title'
     TOPIC = 'topic'
     TOTAL_TIME__S = 'total_time__s'
+    TRIMP = 'trimp'
     UTENSILS = 'utensils'
     YEAR = 'year'
 
@@ -96,11 +173,14 @@ class Post:
     TOPIC_DIE_RUNDE_STUNDE = 'die-runde-stunde'
     TOPIC_FITNESS = 'fitness'
 
-    def __init__(self, file_name, initial_data):
+    def __init__(self, file_name, initial_data, content=""):
 
         # index.md path
         self.file_name = file_name
 
+        # content below the front matter, kept on save
+        self.content = content
+
         # original data
         self.initial_data = initial_data
 
@@ -140,6 +220,20 @@ class Post:
         """
         return os.path.basename(os.path.dirname(self.file_name))
 
+    def get_activity_file(self):
+        """
+        Path of the attached activity file or of its original, if the attachment is a lean one
+        :return: String with the path or None, if the post has no activity file
+        """
+        if self.data.get(self.ACTIVITY, "") == "":
+            return None
+
+        file = os.path.join(os.path.dirname(self.file_name), self.data[self.ACTIVITY])
+        if os.path.exists(f"{file}{original_file_suffix}"):
+            return f"{file}{original_file_suffix}"
+
+        return file
+
     def get_date(self):
         """
         Returns the locale date as a formatted String "%Y-%m-%dT%H:%M:%S"
@@ -244,9 +338,12 @@ class Post:
         :return:
         """
         debug(f"Saving post {self.file_name}")
-        with open(self.file_name, "w") as f:
+        # Replaced at once, so an interrupted or parallel write never leaves a truncated post
+        with open(f"{self.file_name}.tmp", "w") as f:
             f.writelines([
                 "+++\n",
                 f"{toml.dumps(self.data)}",
                 "+++\n",
+                self.content,
             ])
+        os.replace(f"{self.file_name}.tmp", self.file_name)
@@ -0,0 +1,246 @@
+import json
+import os
+
+import numpy as np
+
+from post import Post, list_post_files, read_post_file
+from utility import debug, data_dir, posts_dir
+
+records_file = os.path.join(data_dir, "records.json")
+
+# Number of records per category and effort
+TOP_N = 10
+
+# Standard distances in m for the fastest time and durations in s for the longest distance
+EFFORT_DISTANCES = {'1k': 1000, '5k': 5000, '10k': 10000, '20k': 20000, '40k': 40000}
+EFFORT_DURATIONS = {'5min': 5 * 60, '20min': 20 * 60, '60min': 60 * 60}
+
+TIME_PREFIX = 'time_'
+DISTANCE_PREFIX = 'distance_'
+
+
+def _fastest_time(times, distances, target):
+    """
+    Two-pointer sliding window over the cumulative distance. The window start is interpolated, so it
+    spans exactly the target distance.
+    :param times: List with seconds
+    :param distances: List with non-decreasing cumulative meters
+    :param target: Distance in m
+    :return: Fastest time in s or None, if the activity is shorter
+    """
+    best = None
+    i = 0
+    for j in range(len(distances)):
+        if distances[j] - distances[0] < target:
+            continue
+
+        while distances[j] - distances[i + 1] >= target:
+            i += 1
+
+        start = distances[j] - target
+        if distances[i + 1] > distances[i]:
+            started = times[i] + (times[i + 1] - times[i]) * (start - distances[i]) / (distances[i + 1] - distances[i])
+        else:
+            started = times[i]
+
+        elapsed = times[j] - started
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def _longest_distance(times, distances, duration):
+    """
+    Two-pointer sliding window over the time
+    :param times: List with seconds
+    :param distances: List with non-decreasing cumulative meters
+    :param duration: Duration in s
+    :return: Longest distance in m or None, if the activity is shorter
+    """
+    if len(times) == 0 or times[-1] - times[0] < duration:
+        return None
+
+    best = 0.0
+    i = 0
+    for j in range(len(times)):
+        while times[j] - times[i] > duration:
+            i += 1
+
+        if distances[j] - distances[i] > best:
+            best = distances[j] - distances[i]
+
+    return best
+
+
+def best_efforts(tcxparser):
+    """
+    Fastest times over EFFORT_DISTANCES and longest distances within EFFORT_DURATIONS, in O(n) each
+    :param tcxparser: TCXParser
+    :return: Dict, e.g. {'time_5k__s': 1523, 'distance_20min__m': 8010}. Empty, if there are no distances.
+    """
+    track = tcxparser.track()
+    valid = ~np.isnan(track['time']) & ~np.isnan(track['distance'])
+    times = track['time'][valid].tolist()
+    distances = np.maximum.accumulate(track['distance'][valid]).tolist() if valid.any() else []
+
+    ret = dict()
+    for name, target in EFFORT_DISTANCES.items():
+        value = _fastest_time(times, distances, target)
+        if value is not None:
+            ret[f"{TIME_PREFIX}{name}__s"] = int(round(value))
+
+    for name, duration in EFFORT_DURATIONS.items():
+        value = _longest_distance(times, distances, duration)
+        if value is not None:
+            ret[f"{DISTANCE_PREFIX}{name}__m"] = int(value)
+
+    return ret
+
+
+def set_best_efforts(post, tcxparser):
+    """
+    Set or remove the best efforts in the post
+    :param post: Post
+    :param tcxparser: TCXParser of the post's activity
+    :return: True, if the post data changed
+    """
+    efforts = best_efforts(tcxparser)
+    old = post.data.get(Post.BEST_EFFORTS)
+
+    if len(efforts) > 0:
+        post.data[Post.BEST_EFFORTS] = efforts
+    elif Post.BEST_EFFORTS in post.data:
+        post.data.pop(Post.BEST_EFFORTS)
+
+    return old != post.data.get(Post.BEST_EFFORTS)
+
+
+def _is_better(effort, a, b):
+    if effort.startswith(TIME_PREFIX):
+        return a < b
+
+    return a > b
+
+
+class Records:
+    """
+    Top-N best efforts of all posts by category and effort. A post is only compared with the current top-N,
+    so updating takes constant time regardless of the number of posts. Only if a post drops out of a full list,
+    or stays in it with a worse value, the list is refilled from the front matter of all posts, as the next
+    best effort isn't in the table.
+    """
+
+    def __init__(self, records):
+        # Dict category -> effort -> list of entries, best first
+        self.records = records
+
+    def remove_post(self, post_key, category=None, efforts=None):
+        """
+        Remove the entries of a post
+        :param post_key: e.g. "20201231-172153"
+        :param category: Category of the post's new version, if it will be added again
+        :param efforts: Dict with the best efforts of the post's new version, if it will be added again
+        """
+        refill = []
+        for entry_category, entries_by_effort in self.records.items():
+            for effort, entries in entries_by_effort.items():
+                kept = [e for e in entries if e['post'] != post_key]
+                if len(kept) == len(entries):
+                    continue
+
+                entries_by_effort[effort] = kept
+                old = next(e['value'] for e in entries if e['post'] == post_key)
+                value = efforts.get(effort) if efforts is not None and entry_category == category else None
+                if len(entries) >= TOP_N and (value is None or _is_better(effort, old, value)):
+                    refill.append((entry_category, effort))
+
+        if len(refill) > 0:
+            self._refill(refill, post_key)
+
+        for entry_category in list(self.records.keys()):
+            entries_by_effort = self.records[entry_category]
+            for effort in [e for (e, entries) in entries_by_effort.items() if len(entries) == 0]:
+                entries_by_effort.pop(effort)
+            if len(entries_by_effort) == 0:
+                self.records.pop(entry_category)
+
+    def add_post(self, post):
+        """
+        Insert the best efforts of a post. Entries of an earlier version of the post will be replaced.
+        :param post: Post
+        """
+        category = post.data.get(Post.CATEGORY, Post.CATEGORY_OTHERS)
+        efforts = post.data.get(Post.BEST_EFFORTS, dict())
+        self.remove_post(post.get_dir(), category, efforts)
+
+        for effort, value in efforts.items():
+            self._insert(category, effort, value, post)
+
+    def _insert(self, category, effort, value, post):
+        entries = self.records.setdefault(category, dict()).setdefault(effort, [])
+        # Ties are ordered by post, like in a list built from scratch
+        sign = 1 if effort.startswith(TIME_PREFIX) else -1
+        if len(entries) >= TOP_N and (sign * value, post.get_dir()) >= (sign * entries[-1]['value'],
+                                                                        entries[-1]['post']):
+            return
+
+        entries.append({
+            'post': post.get_dir(),
+            'path': "post/" + os.path.relpath(os.path.dirname(post.file_name), posts_dir),
+            'title': post.data.get(Post.TITLE, ""),
+            'date': post.get_date(),
+            'value': value,
+        })
+        entries.sort(key=lambda e: (sign * e['value'], e['post']))
+        del entries[TOP_N:]
+
+    def _refill(self, pairs, post_key):
+        """
+        Rebuild lists from the front matter of all posts except the given one
+        :param pairs: List with tuples (category, effort)
+        :param post_key: Post to skip, it is added by the caller if needed
+        """
+        debug(f"Refilling records {pairs}")
+        for (category, effort) in pairs:
+            self.records[category][effort] = []
+
+        for post_file in list_post_files():
+            post = read_post_file(post_file)
+            if post.get_dir() == post_key:
+                continue
+
+            category = post.data.get(Post.CATEGORY, Post.CATEGORY_OTHERS)
+            for effort, value in post.data.get(Post.BEST_EFFORTS, dict()).items():
+                if (category, effort) in pairs:
+                    self._insert(category, effort, value, post)
+
+    def save(self):
+        debug(f"Saving records to {records_file}")
+        os.makedirs(data_dir, exist_ok=True)
+        with open(records_file, "w") as f:
+            json.dump(self.records, f, indent=2, sort_keys=True)
+
+
+def read_records():
+    """
+    Read the records table
+    :return: Records, empty if there is none
+    """
+    if not os.path.exists(records_file):
+        return Records(dict())
+
+    with open(records_file, "r") as f:
+        return Records(json.load(f))
+
+
+def build_records():
+    """
+    Build the records table from the best efforts of all posts, e.g. after posts have been deleted
+    :return: Records
+    """
+    records = Records(dict())
+    for post_file in list_post_files():
+        records.add_post(read_post_file(post_file))
+
+    return records
@@ -5,15 +5,39 @@ import sys
 from os import path
 from os.path import basename
 
-from post import read_post_file, read_devices
-from sidecar_tool import read_sidecar, add_sidecar_data
-from tcxparser import TCXParser
-from utility import debug, set_log_switch, out, error, init_out, build_post_path, post_file_name, z_date_to_locale_dt
+from attachment import write_lean_attachment, DEFAULT_TOLERANCE__M, MAX_GAP__S
+from climbs import build_climb_index, set_climbs
+from edit import parse_assignment, parse_rename, parse_date, plan_edit
+from fingerprint import read_fingerprint_index, build_fingerprint
+from fitness import read_fitness, sync_fitness, set_trimp, Fitness
+from heatmap import Heatmap, read_heatmap, add_missing_posts, write_heatmap_image
+from indexes import read_post_indexes, empty_post_indexes
+from journal import start_journal, read_journal, promote, PARSED, WRITTEN, ATTACHED, SIDECAR_APPLIED, DONE, \
+    SKIPPED, journal_file_name
+from odometer import build_odometer
+from post import read_post_file, read_devices, list_post_files, save_posts, check_required
+from records import build_records, set_best_efforts
+from shard import parse_shard, is_in_shard, shard_path, list_shard_dirs, read_manifest, write_manifest, \
+    shard_posts_dir_name
+from sidecar_tool import read_sidecar, add_sidecar_data, plan_sidecar
+from spatial import read_spatial_index, set_route_extent
+from tcxparser import read_activities, count_activities
+from thumbnail import write_route_thumbnail
+from trackcache import write_track_cache, open_activity, TrackCacheParser
+from trackprofile import write_profile
+from utility import debug, set_log_switch, out, error, init_out, build_post_path, post_file_name, \
+    z_date_to_locale_dt, build_post_key, warn, index_dir, posts_dir
 
 args = None
 tcx_suffixes = (".tcx", ".TCX")
 post_file_archetype_path = "../archetypes/post.md"
 
+DUPLICATES_REPORT = 'report'
+DUPLICATES_SKIP = 'skip'
+
+# Options of a load run, kept in the journal for a resume
+LOAD_OPTIONS = ('force', 'delete', 'sidecar', 'stream', 'duplicates', 'lean', 'source_dir')
+
 
 def parse_args():
     global args
@@ -32,9 +56,13 @@ def parse_args():
                                          description=""
                                          )
 
-    load_parser.add_argument('dir', metavar='DIR', type=str,
+    load_parser.add_argument('dir', metavar='DIR', type=str, nargs='?',
                              help="Root directory to search for activity files or a particular file")
 
+    load_parser.add_argument("-r", "--resume",
+                             action='store_true',
+                             help="Continue an interrupted load run with its options. DIR is not needed.")
+
     load_parser.add_argument("-s", "--sidecar",
                              required=False,
                              help="Read additional data from side car file (csv). ")
@@ -47,8 +75,265 @@ def parse_args():
                              action='store_true',
                              help="Overwrite instead of skipping existing posts")
 
+    load_parser.add_argument("-m", "--stream",
+                             action='store_true',
+                             help="Parse activity files in bounded-memory streaming mode, for very large files")
+
+    load_parser.add_argument("-u", "--duplicates",
+                             choices=[DUPLICATES_REPORT, DUPLICATES_SKIP],
+                             default=DUPLICATES_REPORT,
+                             help="Report (default) or skip activities which already exist as post, "
+                                  "e.g. recorded by a second device")
+
+    load_parser.add_argument("-l", "--lean",
+                             action='store_true',
+                             help="Attach a thinned activity file with precompressed variants (.gz, .br) and keep "
+                                  "the original unpublished")
+
+    load_parser.add_argument("--tolerance",
+                             type=float,
+                             default=DEFAULT_TOLERANCE__M,
+                             help="Maximum distance in m of a trackpoint dropped from a lean attachment to the "
+                                  f"route and altitude profile (default {DEFAULT_TOLERANCE__M}). At least one "
+                                  f"trackpoint per {MAX_GAP__S} s is kept for heart rate, cadence etc.")
+
+    load_parser.add_argument("--shard",
+                             type=parse_shard,
+                             help="Load only the i-th of N stable subsets of the activity files (i/N, e.g. 2/4) "
+                                  "into the isolated shard directory, see 'merge'")
+
     load_parser.set_defaults(func=execute_load)
 
+    # ######### rebuild #########
+    rebuild_parser = sub_parsers.add_parser('rebuild',
+                                            help="Recreate the generated files of existing posts",
+                                            description="Derives the generated files (e.g. route thumbnail) "
+                                                        "and values (e.g. best efforts, climbs) of all posts "
+                                                        "again from their activity file. Manually maintained "
+                                                        "values in index.md will not be changed."
+                                            )
+
+    rebuild_parser.add_argument("-m", "--stream",
+                                action='store_true',
+                                help="Parse activity files in bounded-memory streaming mode, for very large files")
+
+    rebuild_parser.add_argument("-t", "--tcx",
+                                action='store_true',
+                                help="Parse the activity files even if a fresh track cache exists")
+
+    rebuild_parser.add_argument("-l", "--lean",
+                                action='store_true',
+                                help="Replace the activity files by thinned ones with precompressed variants "
+                                     "(.gz, .br) and keep the originals unpublished, or thin them again")
+
+    rebuild_parser.add_argument("--tolerance",
+                                type=float,
+                                default=DEFAULT_TOLERANCE__M,
+                                help="Maximum distance in m of a trackpoint dropped from a lean attachment to the "
+                                     f"route and altitude profile (default {DEFAULT_TOLERANCE__M}). At least one "
+                                     f"trackpoint per {MAX_GAP__S} s is kept for heart rate, cadence etc.")
+
+    rebuild_parser.add_argument("--shard",
+                                type=parse_shard,
+                                help="Rebuild only the i-th of N stable subsets of the posts (i/N, e.g. 2/4) "
+                                     "into the isolated shard directory, see 'merge'")
+
+    rebuild_parser.set_defaults(func=execute_rebuild)
+
+    # ######### records #########
+    records_parser = sub_parsers.add_parser('records',
+                                            help="Build the records table from all posts",
+                                            description="Collects the best efforts of all posts into the "
+                                                        "records table again, e.g. after posts have been "
+                                                        "deleted. load and rebuild update it incrementally."
+                                            )
+
+    records_parser.set_defaults(func=execute_records)
+
+    # ######### climbs #########
+    climbs_parser = sub_parsers.add_parser('climbs',
+                                           help="Build the climb index from all posts",
+                                           description="Collects the climbs of all posts into the climb index "
+                                                       "again, e.g. after posts have been deleted. load and "
+                                                       "rebuild update it incrementally."
+                                           )
+
+    climbs_parser.set_defaults(func=execute_climbs)
+
+    # ######### odometer #########
+    odometer_parser = sub_parsers.add_parser('odometer',
+                                             help="Build the device odometer from all posts",
+                                             description="Sums up distance, time, ascent and activities per "
+                                                         "device and utensil of all posts again, e.g. after posts "
+                                                         "have been deleted. load, rebuild and sidecar apply update "
+                                                         "it incrementally."
+                                             )
+
+    odometer_parser.set_defaults(func=execute_odometer)
+
+    # ######### heatmap #########
+    heatmap_parser = sub_parsers.add_parser('heatmap',
+                                            help="Render the heatmap of all posts",
+                                            description="Adds posts missing in the heatmap grid and writes the "
+                                                        "image into the static directory"
+                                            )
+
+    heatmap_parser.add_argument("-r", "--rebuild",
+                                action='store_true',
+                                help="Discard the heatmap grid and bin all posts again")
+
+    heatmap_parser.add_argument("--size",
+                                type=int,
+                                default=2048,
+                                help="Maximum width and height of the image in pixels")
+
+    heatmap_parser.set_defaults(func=execute_heatmap)
+
+    # ######### fitness #########
+    fitness_parser = sub_parsers.add_parser('fitness',
+                                            help="Update the training load series of all posts",
+                                            description="Computes the daily fitness (CTL), fatigue (ATL) and "
+                                                        "form (TSB) from the TRIMP of all posts. Only the days "
+                                                        "from the earliest added, changed or deleted post on "
+                                                        "are computed again. load and rebuild update it "
+                                                        "incrementally."
+                                            )
+
+    fitness_parser.add_argument("-r", "--rebuild",
+                                action='store_true',
+                                help="Discard the series and compute all days again")
+
+    fitness_parser.set_defaults(func=execute_fitness)
+
+    # ######### merge #########
+    merge_parser = sub_parsers.add_parser('merge',
+                                          help="Merge the shards of a load or rebuild into the posts",
+                                          description="Moves the posts of all shards into the content "
+                                                      "directory and updates fingerprints, heatmap, records, "
+                                                      "climbs and training load. Shards are merged in the order "
+                                                      "of their activity files, so existing posts and "
+                                                      "duplicates are resolved like in a single load run. "
+                                                      "Shards of other machines have to be copied into "
+                                                      f"{path.join(index_dir, 'shards')} before."
+                                          )
+
+    merge_parser.add_argument('dirs', metavar='DIR', type=str, nargs='*',
+                              help="Shard directories to merge, default all")
+
+    merge_parser.set_defaults(func=execute_merge)
+
+    # ######### nearby #########
+    nearby_parser = sub_parsers.add_parser('nearby',
+                                           help="List posts starting near a position or post",
+                                           description="Looks up the spatial index of start positions and route "
+                                                       "bboxes, which load and rebuild update incrementally"
+                                           )
+
+    nearby_parser.add_argument('where', metavar='POST|LAT LON', type=str, nargs='+',
+                               help="Post key (e.g. 20201231-172153) or latitude and longitude")
+
+    nearby_parser.add_argument("-r", "--radius",
+                               type=float,
+                               default=1000,
+                               help="Maximum distance of the start position in m")
+
+    nearby_parser.add_argument("--routes",
+                               action='store_true',
+                               help="List also posts whose route passes the radius")
+
+    nearby_parser.set_defaults(func=execute_nearby)
+
+    # ######### sidecar #########
+    sidecar_parser = sub_parsers.add_parser('sidecar',
+                                            help="Apply a side car file (csv) to all existing posts",
+                                            description="Joins the side car file with all posts in one pass "
+                                                        "and rewrites only the posts whose values change. "
+                                                        "The changes are listed before."
+                                            )
+
+    sidecar_parser.add_argument('action', choices=['apply'],
+                                help="apply: Set category, topic, device, utensils etc. from the side car file")
+
+    sidecar_parser.add_argument('file', metavar='FILE', type=str,
+                                help="Side car file (csv)")
+
+    sidecar_parser.add_argument("-n", "--dry-run",
+                                action='store_true',
+                                help="List the changes without writing the posts")
+
+    sidecar_parser.add_argument("-j", "--jobs",
+                                type=int,
+                                default=8,
+                                help="Number of posts written in parallel")
+
+    sidecar_parser.set_defaults(func=execute_sidecar)
+
+    # ######### edit #########
+    edit_parser = sub_parsers.add_parser('edit',
+                                         help="Change the front matter of selected posts",
+                                         description="Selects the posts matching all given --year, --category, "
+                                                     "--topic, --device, --from and --to values, renames, unsets "
+                                                     "and sets keys in this order and rewrites only the posts "
+                                                     "whose values change. The changes are listed before."
+                                         )
+
+    edit_parser.add_argument("--year",
+                             help="Select posts of a year, e.g. 2020")
+
+    edit_parser.add_argument("--category",
+                             help="Select posts of a category, e.g. cycling")
+
+    edit_parser.add_argument("--topic",
+                             help="Select posts of a topic, e.g. pendel")
+
+    edit_parser.add_argument("--device",
+                             help="Select posts of a device, e.g. votec-vrx-pro")
+
+    edit_parser.add_argument("--from",
+                             dest='date_from',
+                             metavar='DATE',
+                             type=parse_date,
+                             help="Select posts from this day on (YYYY-MM-DD)")
+
+    edit_parser.add_argument("--to",
+                             dest='date_to',
+                             metavar='DATE',
+                             type=parse_date,
+                             help="Select posts up to this day (YYYY-MM-DD)")
+
+    edit_parser.add_argument("-s", "--set",
+                             dest='assignments',
+                             metavar='KEY=VALUE',
+                             type=parse_assignment,
+                             action='append',
+                             default=[],
+                             help="Set a key. The value is TOML like in index.md (e.g. draft=false, "
+                                  "'year=\"2020\"'), otherwise a string (e.g. topic=pendel).")
+
+    edit_parser.add_argument("-u", "--unset",
+                             metavar='KEY',
+                             action='append',
+                             default=[],
+                             help="Remove a key")
+
+    edit_parser.add_argument("-r", "--rename",
+                             metavar='OLD=NEW',
+                             type=parse_rename,
+                             action='append',
+                             default=[],
+                             help="Rename a key, keeping its value")
+
+    edit_parser.add_argument("-n", "--dry-run",
+                             action='store_true',
+                             help="List the changes without writing the posts")
+
+    edit_parser.add_argument("-j", "--jobs",
+                             type=int,
+                             default=8,
+                             help="Number of posts written in parallel")
+
+    edit_parser.set_defaults(func=execute_edit)
+
     init_out()
 
     args = parser.parse_args()
@@ -62,42 +347,83 @@ def parse_args():
         out("Don't know what to do!")
 
 
-def do_load(source_dir, force, delete, sidecar):
-    out(f"loading from {source_dir}...")
-    debug(f"load: {force}")
+def source_name(file, source_dir):
+    """
+    Name of an activity file independent from the machine, which orders the files and assigns them to shards
+    :param file: Path of the activity file
+    :param source_dir: Directory or file given to load
+    :return: String with the path relative to source_dir
+    """
+    if source_dir is not None and path.isdir(source_dir):
+        return path.relpath(file, source_dir)
 
-    if not path.exists(source_dir):
-        error(f"Invalid source '{source_dir}'")
+    return basename(file)
 
-    if path.isdir(source_dir):
-        files = list_files(source_dir)
+
+def do_load(source_dir, force, delete, sidecar, stream, duplicates, lean, resume, shard):
+    directory = index_dir if shard is None else shard_path(shard)
+    posts_root = posts_dir if shard is None else path.join(directory, shard_posts_dir_name)
+    if resume:
+        journal = read_journal(directory)
+        # Journals of older versions lack newer options
+        (force, delete, sidecar, stream, duplicates, lean, source_dir) = [journal.options.get(k)
+                                                                          for k in LOAD_OPTIONS]
+        files = [f for f in journal.files() if journal.get(f, 'parent') is None]
+        out(f"resuming load of {len(files)} files...")
     else:
-        files = [source_dir]
+        out(f"loading from {source_dir}...")
 
-    if len(files) == 0:
-        exit("No files found")
+        if source_dir is None or not path.exists(source_dir):
+            error(f"Invalid source '{source_dir}'")
 
-    skipped = 0
-    created = 0
+        if path.isdir(source_dir):
+            files = list_files(source_dir)
+        else:
+            files = [source_dir]
 
-    posts = []
+        files = [f for f in files if f.endswith(tcx_suffixes)]
+        if len(files) == 0:
+            exit("No files found")
 
-    files = [f for f in files if f.endswith(tcx_suffixes)]
-    cnt = 0
-    for f in files:
-        cnt += 1
-        out(f"Processing {cnt}/{len(files)}: {basename(f)}")
+        # A stable order, so shards and a single run resolve existing posts and duplicates the same way
+        files = sorted(files, key=lambda f: source_name(f, source_dir))
+        if shard is not None:
+            files = [f for f in files if is_in_shard(source_name(f, source_dir), shard)]
+            out(f"{len(files)} files in shard {shard[0]}/{shard[1]}")
 
-        post = copy_tcx(f, force, delete)
-        if post:
-            posts.append(post)
-            created += 1
-        else:
-            skipped += 1
+        options = dict(zip(LOAD_OPTIONS, (force, delete, sidecar, stream, duplicates, lean, source_dir)))
+        journal = start_journal(files, options, directory)
 
-    out_tcx = f"{created} posts created, {skipped} skipped."
-    out(out_tcx)
+    debug(f"load: {force}")
+
+    skipped = 0
+    created = 0
+    completed = 0
+
+    fingerprints = read_fingerprint_index()
+    manifest = None
+    if shard is None:
+        heatmap = read_heatmap()
+        indexes = read_post_indexes()
+    else:
+        # A shard only lists its posts in the manifest, the merge updates the other indexes
+        heatmap = Heatmap(dict(), set())
+        indexes = empty_post_indexes()
+        manifest = read_manifest(directory, shard)
+        manifest['options'] = {'force': force, 'duplicates': duplicates}
+        for post_key, entry in manifest['posts'].items():
+            if 'fingerprint' in entry:
+                fingerprints.add(post_key, entry['fingerprint'])
+
+    for source in journal.files():
+        if journal.state(source) in (ATTACHED, SIDECAR_APPLIED, DONE):
+            fingerprints.add(journal.get(source, 'key'), journal.get(source, 'fingerprint'))
+        if manifest is None and journal.state(source) == DONE:
+            # The indexes haven't been saved, if the interrupted run crashed
+            readd_post(journal.get(source, 'key'), journal.get(source, 'post_dir'), heatmap, indexes)
 
+    sidecar_data = None
+    devices = None
     sidecar_added = 0
     sidecar_failed = 0
     if sidecar is not None:
@@ -105,21 +431,64 @@ def do_load(source_dir, force, delete, sidecar):
         debug(f"devices={devices}")
 
         debug("Processing sidecar")
-        data = read_sidecar(sidecar)
+        sidecar_data = read_sidecar(sidecar)
         # debug(f"Sidecar={data}")
-        for p in posts:
-            if add_sidecar_data(p, data, devices):
-                sidecar_added += 1
-            else:
-                sidecar_failed += 1
 
-        if sidecar_added == created:
-            out_sidecar = f"All {sidecar_added} posts updated with Sidecar data, {sidecar_failed} failed."
+    try:
+        cnt = 0
+        for f in files:
+            cnt += 1
+            sources = activity_sources(journal, f)
+            if sources is not None and all(journal.state(s) in (DONE, SKIPPED) for s in sources):
+                debug(f"{basename(f)} completed in previous run")
+                completed += 1
+                continue
+
+            out(f"Processing {cnt}/{len(files)}: {basename(f)}")
+
+            for (source, post) in load_activities(f, journal, force, stream, lean, posts_root, fingerprints,
+                                                  duplicates, heatmap, indexes, sidecar_data, devices):
+                if post:
+                    created += 1
+                    if journal.get(source, 'sidecar'):
+                        sidecar_added += 1
+                    elif sidecar is not None:
+                        sidecar_failed += 1
+                else:
+                    skipped += 1
+
+            if delete and all(journal.state(s) == DONE for s in activity_sources(journal, f)):
+                debug("delete source activity file")
+                os.remove(f)
+
+    finally:
+        if manifest is None:
+            fingerprints.save()
+            heatmap.save()
+            indexes.save()
         else:
-            out_sidecar = f"Only {sidecar_added}/{created} posts updated with Sidecar data, {sidecar_failed} failed."
+            done = [s for s in journal.files() if journal.state(s) == DONE]
+            for s in sorted(done, key=lambda s: (source_name(journal.get(s, 'parent') or s, source_dir),
+                                                 journal.get(s, 'activity') or 1)):
+                manifest['posts'][journal.get(s, 'key')] = {
+                    'path': path.relpath(journal.get(s, 'post_dir'), posts_root),
+                    'source': source_name(journal.get(s, 'parent') or s, source_dir),
+                    'activity': journal.get(s, 'activity') or 1,
+                    'fingerprint': journal.get(s, 'fingerprint'),
+                }
+            write_manifest(directory, manifest)
+        journal.close()
+
+    out_tcx = f"{created} posts created, {skipped} skipped."
+    if completed > 0:
+        out_tcx = f"{out_tcx} {completed} already completed in previous run."
+    out(out_tcx)
 
-    if out_sidecar is not None:
-        out(out_sidecar)
+    if sidecar is not None:
+        if sidecar_added == created:
+            out(f"All {sidecar_added} posts updated with Sidecar data, {sidecar_failed} failed.")
+        else:
+            out(f"Only {sidecar_added}/{created} posts updated with Sidecar data, {sidecar_failed} failed.")
 
 
 def set_params_by_tcx(tcxparser, params):
@@ -135,46 +504,260 @@ def set_params_by_tcx(tcxparser, params):
     return False
 
 
-def copy_tcx(file, force, delete):
+def activity_sources(journal, file):
     """
+    Journal entries of the activities of a file: The file itself for the first activity, "file#2" etc. for
+    further activities
+    :param journal: Journal of the load run
+    :param file: Activity file path
+    :return: List with the entry names or None, if the file has not been parsed completely yet
+    """
+    count = journal.get(file, 'activities')
+    if count is None:
+        return None
+
+    return [file] + [f"{file}#{number}" for number in range(2, count + 1)]
 
-    :param file: tcx file to create a post for
+
+def parse_activities(file, journal, stream):
+    """
+    Parse all activities of a file in one pass and plan a journal entry for each
+    :param file: Activity file path
+    :param journal: Journal of the load run
+    :param stream: true to parse the file with the bounded-memory streaming parser
+    :return: Generator of tuples (journal entry, TCXParser, file name of the post's activity, path of the
+    activity's file)
+    """
+    # A post of a file with several activities gets a file with just its activity, written in the same pass
+    split = count_activities(file) > 1
+    (stem, suffix) = path.splitext(basename(file))
+
+    def split_file(number):
+        source = file if number == 1 else f"{file}#{number}"
+        if source in journal.entries and journal.state(source) in (ATTACHED, SIDECAR_APPLIED, DONE, SKIPPED):
+            return None
+        return journal.activity_path(f"{stem}-{number}{suffix}")
+
+    number = 0
+    for tcxparser in read_activities(file, stream, split_file if split else None):
+        number += 1
+        source = file if number == 1 else f"{file}#{number}"
+        journal.add(source, parent=file, activity=number)
+        attachment = f"{stem}-{number}{suffix}" if split else basename(file)
+        activity_file = journal.activity_path(attachment) if split else file
+
+        yield source, tcxparser, attachment, activity_file
+        # Release the activity before the next one is parsed
+        del tcxparser
+        if split and path.exists(activity_file):
+            # Not moved into a post, e.g. of an existing post
+            os.remove(activity_file)
+
+    if number == 0:
+        warn(f"No activity in {basename(file)}")
+        journal.set(file, SKIPPED, activities=0)
+    else:
+        journal.set(file, journal.state(file), activities=number)
+
+
+def load_activities(file, journal, force, stream, lean, posts_root, fingerprints, duplicates, heatmap, indexes,
+                    sidecar_data, devices):
+    """
+    Create a post for each activity of an activity file, e.g. of a bulk export or the legs of a multisport
+    session. The file is parsed once. It will not be parsed again, if all its posts have been built completely in
+    an interrupted run.
+    :param file: tcx file to create the posts for
+    :param journal: Journal of the load run
     :param force: true to overwrite existing posts
-    :param delete: true to delete source file
+    :param stream: true to parse the file with the bounded-memory streaming parser
+    :param lean: Tolerance in m for lean attachments or None to attach the activity as it is
+    :param posts_root: Directory to create the posts in, e.g. of a shard
+    :param fingerprints: FingerprintIndex of the existing posts, will be updated
+    :param duplicates: DUPLICATES_REPORT or DUPLICATES_SKIP for an activity that already exists as other post
+    :param heatmap: Heatmap of the existing posts, the new trackpoints will be added
+    :param indexes: PostIndexes of the existing posts, will be updated
+    :param sidecar_data: Dictionary with the sidecar data or None
+    :param devices: dict with HUGO devices or None
+    :return: Generator of tuples (journal entry, post object or False, if skipped)
+    """
+    sources = activity_sources(journal, file)
+    if sources is not None and all(journal.state(s) in (ATTACHED, SIDECAR_APPLIED, DONE, SKIPPED) for s in sources):
+        activities = ((s, None, None, None) for s in sources)
+    else:
+        activities = parse_activities(file, journal, stream)
+
+    for (source, tcxparser, attachment, activity_file) in activities:
+        if journal.state(source) in (DONE, SKIPPED):
+            # Release the activity before the next one is parsed
+            del tcxparser
+            continue
+
+        if source != file:
+            debug(f"Activity {journal.get(source, 'activity')} of {basename(file)}")
+
+        post = load_file(source, file, tcxparser, attachment, activity_file, journal, force, lean, posts_root,
+                         fingerprints, duplicates, heatmap, indexes, sidecar_data, devices)
+        # Release the activity before the next one is parsed
+        del tcxparser
+        yield source, post
+
+
+def load_file(source, file, tcxparser, attachment, activity_file, journal, force, lean, posts_root, fingerprints,
+              duplicates, heatmap, indexes, sidecar_data, devices):
+    """
+    Create the post for an activity in the staging area and promote it to the content directory
+    :param source: Journal entry of the activity
+    :param file: tcx file of the activity
+    :param tcxparser: TCXParser of the activity or None, if the post has been built in an interrupted run
+    :param attachment: File name of the post's activity file
+    :param activity_file: Path of the activity's file, the tcx file itself or just the activity
+    :param journal: Journal of the load run
+    :param force: true to overwrite existing posts
+    :param lean: Tolerance in m for a lean attachment or None to attach the activity as it is
+    :param posts_root: Directory to create the post in, e.g. of a shard
+    :param fingerprints: FingerprintIndex of the existing posts, will be updated
+    :param duplicates: DUPLICATES_REPORT or DUPLICATES_SKIP for an activity that already exists as other post
+    :param heatmap: Heatmap of the existing posts, the new trackpoints will be added
+    :param indexes: PostIndexes of the existing posts, will be updated
+    :param sidecar_data: Dictionary with the sidecar data or None
+    :param devices: dict with HUGO devices or None
+    :return: post object or False, if skipped
+    """
+    state = journal.state(source)
+    resumed = state in (ATTACHED, SIDECAR_APPLIED)
+    promoted = False
+    if resumed:
+        debug(f"Continuing {basename(source)} from state {state}")
+        staging_dir = journal.staging_path(journal.get(source, 'key'))
+        # Interrupted after the promotion, before DONE has been journaled
+        promoted = not path.exists(staging_dir) and path.exists(journal.get(source, 'post_dir'))
+        post = read_post_file(path.join(journal.get(source, 'post_dir') if promoted else staging_dir, post_file_name))
+    else:
+        post = copy_tcx(source, file, tcxparser, attachment, activity_file, force, lean, posts_root, fingerprints,
+                        duplicates, heatmap, journal)
+        if not post:
+            journal.set(source, SKIPPED)
+            return False
+        state = journal.state(source)
+
+    if sidecar_data is not None and state != SIDECAR_APPLIED:
+        journal.set(source, SIDECAR_APPLIED, sidecar=add_sidecar_data(post, sidecar_data, devices))
+
+    post_dir = journal.get(source, 'post_dir')
+    if not promoted:
+        promote(path.dirname(post.file_name), post_dir)
+        post.file_name = path.join(post_dir, post_file_name)
+    journal.set(source, DONE)
+    if resumed:
+        # The heatmap of the interrupted run hasn't been saved, if it crashed
+        add_to_heatmap(heatmap, journal.get(source, 'key'), post)
+    indexes.add_post(post)
+
+    return post
+
+
+def readd_post(post_key, post_dir, heatmap, indexes):
+    """
+    Add a post completed in an interrupted run to the indexes again
+    :param post_key: e.g. "20201231-172153"
+    :param post_dir: Directory of the post
+    :param heatmap: Heatmap, the post's trackpoints will be added, if missing
+    :param indexes: PostIndexes, the post will be replaced
+    """
+    post_file = path.join(post_dir, post_file_name)
+    if not path.exists(post_file):
+        warn(f"Post {post_key} has been deleted after the interrupted run")
+        return
+
+    post = read_post_file(post_file)
+    add_to_heatmap(heatmap, post_key, post)
+    indexes.add_post(post)
+
+
+def add_to_heatmap(heatmap, post_key, post):
+    """
+    Add the trackpoints of a post to the heatmap, if they are missing
+    :param heatmap: Heatmap
+    :param post_key: e.g. "20201231-172153"
+    :param post: Post with its activity file
+    """
+    if post_key in heatmap.posts:
+        return
+
+    tcxparser = open_activity(post, stream=True)
+    if tcxparser is not None:
+        heatmap.add(post_key, tcxparser.latitude_values(), tcxparser.longitude_values())
+
+
+def copy_tcx(source, file, tcxparser, attachment, activity_file, force, lean, posts_root, fingerprints, duplicates,
+             heatmap, journal):
+    """
+    Build the post for an activity in the staging area
+    :param source: Journal entry of the activity
+    :param file: tcx file of the activity
+    :param tcxparser: TCXParser of the activity
+    :param attachment: File name of the post's activity file, the file itself or just the activity
+    :param activity_file: Path of the activity's file, the tcx file itself or just the activity
+    :param force: true to overwrite existing posts
+    :param lean: Tolerance in m for a lean attachment or None to attach the activity as it is
+    :param posts_root: Directory to create the post in, e.g. of a shard
+    :param fingerprints: FingerprintIndex of the existing posts, will be updated
+    :param duplicates: DUPLICATES_REPORT or DUPLICATES_SKIP for an activity that already exists as other post
+    :param heatmap: Heatmap of the existing posts, the new trackpoints will be added
+    :param journal: Journal of the load run
     :return: post object or False, if skipped
     """
-    tcxparser = TCXParser(file)
     date = z_date_to_locale_dt(tcxparser.started_at, tcxparser.latitude, tcxparser.longitude)
-    post_dir = build_post_path(date)
+    post_dir = build_post_path(date, posts_root)
+    post_key = build_post_key(date)
+    journal.set(source, PARSED, key=post_key, post_dir=post_dir)
 
-    if path.exists(post_dir):
-        if force:
-            debug(f"removing existing {post_dir}")
-            shutil.rmtree(post_dir)
+    # A shard also skips posts which exist in the content directory
+    if not force and (path.exists(post_dir) or path.exists(build_post_path(date))):
+        debug(f"skipping existing {post_dir}")
+        return False
 
-        else:
-            debug(f"skipping existing {post_dir}")
+    fingerprint = build_fingerprint(tcxparser)
+    duplicate = fingerprints.find_duplicate(fingerprint, ignore_key=post_key)
+    if duplicate is not None:
+        if duplicates == DUPLICATES_SKIP:
+            warn(f"Skipping {attachment}: Same activity as post {duplicate}")
             return False
 
-    debug(f"mkdir {post_dir}")
-    os.makedirs(post_dir, exist_ok=False)
+        warn(f"{attachment} is the same activity as post {duplicate}")
 
-    post_path = path.join(post_dir, post_file_name)
-    shutil.copyfile(post_file_archetype_path, post_path)
-    shutil.copyfile(file, path.join(post_dir, path.basename(file)))
+    staging_dir = journal.staging_path(post_key)
+    if path.exists(staging_dir):
+        debug(f"removing incomplete {staging_dir}")
+        shutil.rmtree(staging_dir)
+
+    debug(f"mkdir {staging_dir}")
+    os.makedirs(staging_dir, exist_ok=False)
 
-    if delete:
-        debug("delete source activity file")
-        os.remove(file)
+    post_path = path.join(staging_dir, post_file_name)
+    shutil.copyfile(post_file_archetype_path, post_path)
 
     post = read_post_file(post_path)
     # debug(f"post={post}")
     debug(f"tcx={tcxparser}")
 
-    post.set_tcx_data(tcxparser, file)
+    post.set_tcx_data(tcxparser, attachment)
+    derive_post_data(post, tcxparser)
 
     # debug(f"post={json.dumps(post.data, indent=2, sort_keys=True)}")
     post.save()
+    journal.set(source, WRITTEN)
+
+    if activity_file == file:
+        shutil.copyfile(file, path.join(staging_dir, attachment))
+    else:
+        os.replace(activity_file, path.join(staging_dir, attachment))
+    if lean is not None:
+        write_lean_attachment(post, path.join(staging_dir, attachment), lean)
+    derive_post_files(post, tcxparser)
+    fingerprints.add(post_key, fingerprint)
+    heatmap.add(post_key, tcxparser.latitude_values(), tcxparser.longitude_values())
+    journal.set(source, ATTACHED, fingerprint=fingerprint)
 
     debug(f"Post created")
     # print(x.strftime("%b %d %Y %H:%M:%S"))
@@ -183,6 +766,331 @@ def copy_tcx(file, force, delete):
     return post
 
 
+def derive_post_data(post, tcxparser):
+    """
+    Set all values derived from the activity's trackpoints
+    :param post: Post
+    :param tcxparser: TCXParser of the post's activity file or its TrackCacheParser
+    :return: True, if the post data changed
+    """
+    changed = set_best_efforts(post, tcxparser)
+    changed = set_climbs(post, tcxparser) or changed
+    changed = set_trimp(post, tcxparser) or changed
+    changed = set_route_extent(post, tcxparser) or changed
+
+    return changed
+
+
+def derive_post_files(post, tcxparser):
+    """
+    Write all files generated from the activity into the post's directory
+    :param post: Post
+    :param tcxparser: TCXParser of the post's activity file or its TrackCacheParser
+    """
+    if not isinstance(tcxparser, TrackCacheParser):
+        write_track_cache(post, tcxparser)
+    write_route_thumbnail(post, tcxparser)
+    write_profile(post, tcxparser)
+
+
+def do_rebuild(stream, tcx, lean, shard):
+    out("Rebuilding posts...")
+
+    manifest = None
+    if shard is None:
+        indexes = read_post_indexes()
+    else:
+        # A shard only lists its posts in the manifest, the merge updates the indexes
+        indexes = empty_post_indexes()
+        manifest = read_manifest(shard_path(shard), shard)
+
+    post_files = [f for f in list_post_files() if is_in_shard(basename(path.dirname(f)), shard)]
+    rebuilt = 0
+    updated = 0
+    cnt = 0
+    for post_file in post_files:
+        cnt += 1
+        post = read_post_file(post_file)
+        out(f"Processing {cnt}/{len(post_files)}: {post.get_dir()}")
+
+        tcxparser = open_activity(post, stream, use_cache=not tcx)
+        if tcxparser is None:
+            warn(f"No activity file for {post.get_dir()}, skipped")
+            continue
+
+        activity_file = post.get_activity_file()
+        if manifest is not None:
+            # Changed files are written into the shard, the merge moves them into the post
+            relative = path.relpath(path.dirname(post_file), posts_dir)
+            post.file_name = path.join(shard_path(shard), shard_posts_dir_name, relative, post_file_name)
+            os.makedirs(path.dirname(post.file_name), exist_ok=True)
+            manifest['posts'][post.get_dir()] = {'path': relative, 'source': post.get_dir(), 'rebuild': True}
+
+        if derive_post_data(post, tcxparser):
+            post.save()
+            updated += 1
+
+        derive_post_files(post, tcxparser)
+        if lean is not None and path.exists(activity_file):
+            write_lean_attachment(post, activity_file, lean)
+        indexes.add_post(post)
+        rebuilt += 1
+
+    if manifest is None:
+        indexes.save()
+    else:
+        write_manifest(shard_path(shard), manifest)
+    out(f"{rebuilt} posts rebuilt ({updated} with changed values), {len(post_files) - rebuilt} skipped.")
+
+
+def do_records():
+    out("Building records...")
+    records = build_records()
+    records.save()
+    out(f"Records of {len(records.records)} categories saved.")
+
+
+def do_heatmap(rebuild, size):
+    out("Updating heatmap...")
+    if rebuild:
+        heatmap = Heatmap(dict(), set())
+    else:
+        heatmap = read_heatmap()
+
+    added = add_missing_posts(heatmap)
+    heatmap.save()
+    out(f"{added} posts added to heatmap with {len(heatmap.posts)} posts.")
+
+    write_heatmap_image(heatmap, size)
+
+
+def do_fitness(rebuild):
+    out("Updating training load...")
+    if rebuild:
+        fitness = Fitness(dict(), [])
+    else:
+        fitness = read_fitness()
+
+    sync_fitness(fitness)
+    days = fitness.update()
+    fitness.save()
+    out(f"{days} days computed, series of {len(fitness.series)} days with {len(fitness.activities)} posts saved.")
+
+
+def do_merge(shard_dirs):
+    if len(shard_dirs) == 0:
+        shard_dirs = list_shard_dirs()
+    if len(shard_dirs) == 0:
+        exit("No shards found")
+
+    manifests = [(d, read_manifest(d)) for d in shard_dirs]
+    # An interrupted load keeps its journal until it has been resumed to the end
+    interrupted = [m['shard'] for (d, m) in manifests if path.exists(path.join(d, journal_file_name))]
+    if len(interrupted) > 0:
+        error("Load of shards " + ", ".join(f"{i}/{n}" for (i, n) in interrupted) + " has been interrupted, "
+              "complete it before the merge with " + ", ".join(f"'load --shard {i}/{n} --resume'"
+                                                                for (i, n) in interrupted))
+
+    counts = set(m['shard'][1] for (d, m) in manifests)
+    if len(counts) > 1:
+        error(f"Can't merge shards of runs with different numbers of shards {sorted(counts)}")
+    missing = sorted(set(range(1, counts.pop() + 1)) - set(m['shard'][0] for (d, m) in manifests))
+    if len(missing) > 0:
+        warn(f"Shards {missing} missing, they can be merged later")
+
+    out(f"Merging {len(manifests)} shards...")
+
+    # In the order of a single run, see do_load()
+    entries = sorted(((entry['source'], d, post_key, entry, m['options'])
+                      for (d, m) in manifests for (post_key, entry) in m['posts'].items()),
+                     key=lambda e: (e[0], e[3].get('activity', 1), e[1]))
+
+    fingerprints = read_fingerprint_index()
+    heatmap = read_heatmap()
+    indexes = read_post_indexes()
+    merged = 0
+    skipped = 0
+    try:
+        for (source, directory, post_key, entry, options) in entries:
+            shard_post_dir = path.join(directory, shard_posts_dir_name, entry['path'])
+            post_dir = path.join(posts_dir, entry['path'])
+            if not path.exists(shard_post_dir):
+                debug(f"{post_key} merged before")
+                continue
+
+            if entry.get('rebuild'):
+                if not path.exists(post_dir):
+                    warn(f"Skipping {post_key}: Post has been deleted")
+                    shutil.rmtree(shard_post_dir)
+                    skipped += 1
+                    continue
+
+                for f in os.listdir(shard_post_dir):
+                    os.replace(path.join(shard_post_dir, f), path.join(post_dir, f))
+                os.rmdir(shard_post_dir)
+                post = read_post_file(path.join(post_dir, post_file_name))
+            else:
+                post = merge_loaded_post(source, post_key, entry, options, shard_post_dir, post_dir, fingerprints,
+                                         heatmap)
+                if not post:
+                    shutil.rmtree(shard_post_dir)
+                    skipped += 1
+                    continue
+
+            indexes.add_post(post)
+            merged += 1
+
+    finally:
+        fingerprints.save()
+        heatmap.save()
+        indexes.save()
+
+    for d in shard_dirs:
+        shutil.rmtree(d)
+
+    out(f"{merged} posts merged, {skipped} skipped.")
+
+
+def merge_loaded_post(source, post_key, entry, options, shard_post_dir, post_dir, fingerprints, heatmap):
+    """
+    Move a post created by a shard into the content directory, resolving an existing post or duplicate like
+    copy_tcx()
+    :param source: Name of the activity file
+    :param post_key: e.g. "20201231-172153"
+    :param entry: Dict with the post's manifest entry
+    :param options: Dict with 'force' and 'duplicates' of the shard's load run
+    :param shard_post_dir: Directory of the post in the shard
+    :param post_dir: Target directory
+    :param fingerprints: FingerprintIndex of the existing posts, will be updated
+    :param heatmap: Heatmap of the existing posts, the new trackpoints will be added
+    :return: post object or False, if skipped
+    """
+    if path.exists(post_dir) and not options['force']:
+        debug(f"skipping {source}: existing {post_dir}")
+        return False
+
+    duplicate = fingerprints.find_duplicate(entry['fingerprint'], ignore_key=post_key)
+    if duplicate is not None:
+        if options['duplicates'] == DUPLICATES_SKIP:
+            warn(f"Skipping {source}: Same activity as post {duplicate}")
+            return False
+
+        warn(f"{source} is the same activity as post {duplicate}")
+
+    promote(shard_post_dir, post_dir)
+    post = read_post_file(path.join(post_dir, post_file_name))
+    fingerprints.add(post_key, entry['fingerprint'])
+    add_to_heatmap(heatmap, post_key, post)
+
+    return post
+
+
+def do_nearby(where, radius, routes):
+    spatial = read_spatial_index()
+    if len(spatial.changed) > 0:
+        spatial.save()
+
+    if len(where) == 1:
+        if where[0] not in spatial.posts:
+            error(f"Unknown post or post without position '{where[0]}'")
+        (latitude, longitude) = spatial.posts[where[0]]['start']
+    elif len(where) == 2:
+        try:
+            (latitude, longitude) = [float(v) for v in where]
+        except ValueError:
+            error(f"Invalid position '{' '.join(where)}'")
+    else:
+        error("Expected a post key or latitude and longitude")
+
+    found = spatial.nearby(latitude, longitude, radius, routes)
+    for (distance, post_key) in found:
+        entry = spatial.posts[post_key]
+        out(f"{int(distance):>7} m  {post_key}  {entry['title']}")
+
+    out(f"{len(found)} posts found.")
+
+
+def do_sidecar_apply(sidecar, dry_run, jobs):
+    out(f"Applying {sidecar} to all posts...")
+    devices = read_devices()
+    sidecar_data = read_sidecar(sidecar)
+    (changed, missing) = plan_sidecar(sidecar_data, devices)
+
+    if len(missing) > 0:
+        debug(f"Posts without sidecar item: {', '.join(missing)}")
+    out(f"{report_changes(changed)}, {len(missing)} posts without sidecar item.")
+
+    if not dry_run:
+        save_changes(changed, jobs)
+
+
+def do_edit(selection, assignments, unsets, renames, dry_run, jobs):
+    if len(assignments) + len(unsets) + len(renames) == 0:
+        error("Nothing to edit, use --set, --unset or --rename")
+
+    out("Editing posts...")
+    (changed, selected) = plan_edit(selection, assignments, unsets, renames)
+    out(f"{report_changes(changed)}, {selected - len(changed)} of {selected} selected posts unchanged.")
+
+    if not dry_run:
+        save_changes(changed, jobs)
+
+
+def report_changes(changed):
+    """
+    List the changes of each post
+    :param changed: List with tuples (post, changes), see diff_data()
+    :return: String with the summary, e.g. "2 posts change (draft 2)"
+    """
+    keys = dict()
+    for (post, changes) in changed:
+        texts = []
+        for (key, old, new) in changes:
+            keys[key] = keys.get(key, 0) + 1
+            if new is None:
+                texts.append(f"{key} removed")
+            elif old is None:
+                texts.append(f"{key} = {new!r}")
+            else:
+                texts.append(f"{key} {old!r} -> {new!r}")
+        out(f"{post.get_dir()}: {', '.join(texts)}")
+
+    summary = ", ".join(f"{key} {count}" for (key, count) in sorted(keys.items()))
+    return f"{len(changed)} posts change{f' ({summary})' if len(changed) > 0 else ''}"
+
+
+def save_changes(changed, jobs):
+    """
+    Write the changed posts in parallel and update the indexes with their front matter. Refuses to save
+    anything, if a post would lose one of its required keys, see check_required().
+    :param changed: List with tuples (post, changes), see diff_data()
+    :param jobs: Number of parallel writes
+    """
+    if len(changed) == 0:
+        return
+
+    posts = [post for (post, changes) in changed]
+    # A post without e.g. its date can neither be indexed nor read by later runs, so nothing is saved
+    invalid = 0
+    for post in posts:
+        problems = check_required(post.data)
+        if len(problems) > 0:
+            invalid += 1
+            out(f"{post.get_dir()}: {', '.join(problems)}")
+    if invalid > 0:
+        error(f"{invalid} posts would become invalid, nothing saved.")
+
+    save_posts(posts, jobs)
+
+    # E.g. the category sorts the best efforts into the records, the title is shown in the climbs and
+    # related routes, device and utensils are summed up in the odometer
+    indexes = read_post_indexes()
+    for post in posts:
+        indexes.add_post(post)
+    indexes.save()
+    out(f"{len(posts)} posts saved.")
+
+
 def list_files(dir):
     r = []
     subdirs = [x[0] for x in os.walk(dir)]
@@ -196,7 +1104,63 @@ def list_files(dir):
 
 
 def execute_load():
-    do_load(args.dir, args.force, args.delete, args.sidecar)
+    do_load(args.dir, args.force, args.delete, args.sidecar, args.stream, args.duplicates,
+            args.tolerance if args.lean else None, args.resume, args.shard)
+
+
+def execute_rebuild():
+    do_rebuild(args.stream, args.tcx, args.tolerance if args.lean else None, args.shard)
+
+
+def execute_records():
+    do_records()
+
+
+def do_climbs():
+    out("Building climb index...")
+    climbs = build_climb_index()
+    climbs.save()
+    out(f"{len(climbs.climbs)} climbs saved.")
+
+
+def execute_climbs():
+    do_climbs()
+
+
+def do_odometer():
+    out("Building odometer...")
+    odometer = build_odometer()
+    odometer.save()
+    out(f"{len(odometer.devices)} devices with {len(odometer.usages)} posts saved.")
+
+
+def execute_odometer():
+    do_odometer()
+
+
+def execute_heatmap():
+    do_heatmap(args.rebuild, args.size)
+
+
+def execute_fitness():
+    do_fitness(args.rebuild)
+
+
+def execute_merge():
+    do_merge(args.dirs)
+
+
+def execute_nearby():
+    do_nearby(args.where, args.radius, args.routes)
+
+
+def execute_sidecar():
+    do_sidecar_apply(args.file, args.dry_run, args.jobs)
+
+
+def execute_edit():
+    selection = {k: getattr(args, k) for k in ('year', 'category', 'topic', 'device', 'date_from', 'date_to')}
+    do_edit(selection, args.assignments, args.unset, args.rename, args.dry_run, args.jobs)
 
 
 if __name__ == '__main__':
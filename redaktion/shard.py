@@ -0,0 +1,88 @@
+import argparse
+import hashlib
+import json
+import os
+
+from utility import debug, index_dir
+
+shards_dir = os.path.join(index_dir, "shards")
+manifest_file_name = "manifest.json"
+# Posts of a shard are built in this subdirectory of the shard directory, like in the content directory
+shard_posts_dir_name = "post"
+
+
+def parse_shard(text):
+    """
+    Parse the shard argument
+    :param text: String "i/N", e.g. "2/4" for the second of four shards
+    :return: Tuple (i, N)
+    """
+    try:
+        (index, count) = [int(v) for v in text.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{text}', expected i/N, e.g. 2/4")
+
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{text}', i must be within 1 and N")
+
+    return index, count
+
+
+def is_in_shard(name, shard):
+    """
+    Stable assignment of an input to a shard, independent from machine, platform and Python hash seed
+    :param name: Name of the input, e.g. the path of an activity file relative to the load directory
+    :param shard: Tuple (i, N) or None for all inputs
+    :return: True, if the input belongs to the shard
+    """
+    if shard is None:
+        return True
+
+    digest = hashlib.sha1(name.replace(os.sep, "/").encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shard[1] == shard[0] - 1
+
+
+def shard_path(shard):
+    """
+    Isolated directory of a shard with its journal, manifest and posts
+    :param shard: Tuple (i, N)
+    :return: String with path, e.g. "index/shards/2-of-4"
+    """
+    return os.path.join(shards_dir, f"{shard[0]}-of-{shard[1]}")
+
+
+def list_shard_dirs():
+    """
+    :return: List with the directories of all shards waiting for a merge, sorted
+    """
+    if not os.path.exists(shards_dir):
+        return []
+
+    return sorted(os.path.join(shards_dir, d) for d in os.listdir(shards_dir)
+                  if os.path.exists(os.path.join(shards_dir, d, manifest_file_name)))
+
+
+def read_manifest(directory, shard=None):
+    """
+    Read the manifest of a shard, which lists its posts for the merge
+    :param directory: Shard directory
+    :param shard: Tuple (i, N) for a new manifest, if there is none
+    :return: Dict with 'shard' [i, N], 'options' of the run and 'posts' by post key. A post has the 'path'
+    relative to the posts directory, the 'source' name it is ordered by and either the 'fingerprint' of a
+    loaded activity or 'rebuild' True.
+    """
+    file = os.path.join(directory, manifest_file_name)
+    if not os.path.exists(file):
+        return {'shard': list(shard), 'options': dict(), 'posts': dict()}
+
+    with open(file, "r") as f:
+        return json.load(f)
+
+
+def write_manifest(directory, manifest):
+    file = os.path.join(directory, manifest_file_name)
+    debug(f"Saving {len(manifest['posts'])} posts to {file}")
+    os.makedirs(directory, exist_ok=True)
+    with open(f"{file}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(f"{file}.tmp", file)
@@ -1,8 +1,9 @@
+import copy
 import csv
 import os
 from datetime import datetime, timedelta
 
-from post import read_post_file, Post
+from post import read_post_file, list_post_files, diff_data, Post
 from utility import debug, post_file_name, error, out, warn, build_post_key
 
 
@@ -62,6 +63,20 @@ def add_sidecar_data(post, data, devices):
 
     debug(f"item={item}")
 
+    apply_sidecar_item(post, item, devices)
+
+    post.save()
+
+    return True
+
+
+def apply_sidecar_item(post, item, devices):
+    """
+    Set the attributes of a sidecar item in the post data, without saving the post
+    :param post: Post object
+    :param item: Sidecar item of the post
+    :param devices: dict with HUGO devices
+    """
     materials = get_material_list(item, devices)
 
     set_category(post, item)
@@ -76,9 +91,31 @@ def add_sidecar_data(post, data, devices):
 
     set_or_remove( len(map_utensils(materials)) > 0, post, Post.UTENSILS, map_utensils(materials))
 
-    post.save()
 
-    return True
+def plan_sidecar(data, devices):
+    """
+    Apply the sidecar data to all existing posts in memory
+    :param data: Dictionary with the sidecar data
+    :param devices: dict with HUGO devices
+    :return: Tuple (list with tuples (post, changes) of the posts whose data changes, see diff_data(),
+    list with the keys of the posts without sidecar item)
+    """
+    changed = []
+    missing = []
+    for post_file in list_post_files():
+        post = read_post_file(post_file)
+        item = find_item_by_key(data, post)
+        if item is None:
+            missing.append(post.get_dir())
+            continue
+
+        old = copy.deepcopy(post.data)
+        apply_sidecar_item(post, item, devices)
+        changes = diff_data(old, post.data)
+        if len(changes) > 0:
+            changed.append((post, changes))
+
+    return changed, missing
 
 
 def set_or_remove_sport(switch, post, devices):
@@ -94,7 +131,7 @@ def set_or_remove_sport(switch, post, devices):
         post.data[key] = value
     else:
         if key in post.data:
-            post.data.remove(key)
+            post.data.pop(key)
 
 
 def set_category(post, item):
@@ -149,7 +186,7 @@ def set_or_remove(switch, post, key, value):
         post.data[key] = value
     else:
         if key in post.data:
-            post.data.remove(key)
+            post.data.pop(key)
 
 
 def map_sport(device, devices):
@@ -0,0 +1,258 @@
+import json
+import math
+import os
+
+import numpy as np
+
+from post import Post, list_post_files, read_post_file
+from utility import debug, out, warn, index_dir, posts_dir
+
+spatial_file = os.path.join(index_dir, "spatial.json")
+related_file_name = "related.json"
+
+# Grid cells in degrees: start positions in about 1 km cells, route bboxes in about 25 km cells
+START_CELL__DEG = 0.01
+ROUTE_CELL__DEG = 0.25
+
+# Related routes start within this distance and their bboxes overlap by this ratio (intersection over union)
+RELATED_START__M = 500
+MIN_RELATED_OVERLAP = 0.5
+MAX_RELATED = 10
+
+EARTH_RADIUS__M = 6371000
+
+
+def set_route_extent(post, tcxparser):
+    """
+    Set or remove the start position (the first position, like for the timezone) and the route bbox in the post
+    :param post: Post
+    :param tcxparser: TCXParser of the post's activity
+    :return: True, if the post data changed
+    """
+    old = (post.data.get(Post.START_POSITION), post.data.get(Post.ROUTE_BBOX))
+    latitudes = np.asarray(tcxparser.latitude_values(), dtype=float)
+    longitudes = np.asarray(tcxparser.longitude_values(), dtype=float)
+
+    if len(latitudes) > 0:
+        post.data[Post.START_POSITION] = [round(float(tcxparser.latitude), 6), round(float(tcxparser.longitude), 6)]
+        post.data[Post.ROUTE_BBOX] = [round(float(v), 6) for v in (latitudes.min(), longitudes.min(),
+                                                                    latitudes.max(), longitudes.max())]
+    else:
+        post.data.pop(Post.START_POSITION, None)
+        post.data.pop(Post.ROUTE_BBOX, None)
+
+    return old != (post.data.get(Post.START_POSITION), post.data.get(Post.ROUTE_BBOX))
+
+
+def distance__m(a, b):
+    """
+    Great-circle distance
+    :param a: Tuple or list with lat, lon
+    :param b: Tuple or list with lat, lon
+    :return: Distance in m
+    """
+    (lat1, lon1, lat2, lon2) = [math.radians(v) for v in (a[0], a[1], b[0], b[1])]
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS__M * math.asin(min(1.0, math.sqrt(h)))
+
+
+def bbox_overlap(a, b):
+    """
+    :param a: List with min lat, min lon, max lat, max lon
+    :param b: List with min lat, min lon, max lat, max lon
+    :return: Intersection over union of the areas, 0.0 to 1.0
+    """
+    intersection = max(0.0, min(a[2], b[2]) - max(a[0], b[0])) * max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    if union <= 0:
+        # Routes without extent, e.g. on a treadmill
+        return 1.0 if a == b else 0.0
+
+    return intersection / union
+
+
+def _intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _cell(latitude, longitude, size):
+    return math.floor(latitude / size), math.floor(longitude / size)
+
+
+def _cells(bbox, size):
+    (lat_min, lon_min) = _cell(bbox[0], bbox[1], size)
+    (lat_max, lon_max) = _cell(bbox[2], bbox[3], size)
+    return [(i, j) for i in range(lat_min, lat_max + 1) for j in range(lon_min, lon_max + 1)]
+
+
+class SpatialIndex:
+    """
+    Start positions and route bboxes of all posts in grids. Lookups only check the posts in the cells around
+    the query, so they take roughly constant time regardless of the number of posts.
+    """
+
+    def __init__(self, posts):
+        # Dict post key -> {'start': [lat, lon], 'bbox': [min lat, min lon, max lat, max lon], 'path', 'title', 'date'}
+        self.posts = posts
+        # Dict cell -> set of post keys
+        self.starts = dict()
+        self.routes = dict()
+        # Post keys, whose related routes have to be written
+        self.changed = set()
+        for post_key in posts:
+            self._insert(post_key)
+
+    def _insert(self, post_key):
+        entry = self.posts[post_key]
+        self.starts.setdefault(_cell(entry['start'][0], entry['start'][1], START_CELL__DEG), set()).add(post_key)
+        for cell in _cells(entry['bbox'], ROUTE_CELL__DEG):
+            self.routes.setdefault(cell, set()).add(post_key)
+
+    def remove_post(self, post_key):
+        if post_key not in self.posts:
+            return
+
+        self.changed.update(k for (o, k) in self.related(post_key))
+        entry = self.posts.pop(post_key)
+        self.starts[_cell(entry['start'][0], entry['start'][1], START_CELL__DEG)].discard(post_key)
+        for cell in _cells(entry['bbox'], ROUTE_CELL__DEG):
+            self.routes[cell].discard(post_key)
+
+    def add_post(self, post):
+        """
+        Add the start position and route bbox of a post. An earlier version of the post will be replaced.
+        :param post: Post
+        """
+        post_key = post.get_dir()
+        self.remove_post(post_key)
+        self.changed.add(post_key)
+        if Post.START_POSITION not in post.data:
+            return
+
+        self.posts[post_key] = {
+            'start': post.data[Post.START_POSITION],
+            'bbox': post.data[Post.ROUTE_BBOX],
+            'path': os.path.relpath(os.path.dirname(post.file_name), posts_dir),
+            'title': post.data.get(Post.TITLE, ""),
+            'date': post.get_date(),
+        }
+        self._insert(post_key)
+        self.changed.update(k for (o, k) in self.related(post_key))
+
+    def nearby(self, latitude, longitude, radius__m, routes=False):
+        """
+        Find posts starting near a position
+        :param latitude: float
+        :param longitude: float
+        :param radius__m: Maximum distance of the start position
+        :param routes: True to find also posts whose route bbox is within the radius
+        :return: List with tuples (distance of the start in m, post key), nearest first
+        """
+        radius__deg = math.degrees(radius__m / EARTH_RADIUS__M)
+        longitude_radius__deg = radius__deg / max(math.cos(math.radians(latitude)), 0.01)
+        query = [latitude - radius__deg, longitude - longitude_radius__deg,
+                 latitude + radius__deg, longitude + longitude_radius__deg]
+
+        candidates = set()
+        for cell in _cells(query, START_CELL__DEG):
+            candidates.update(self.starts.get(cell, ()))
+
+        ret = []
+        for post_key in candidates:
+            distance = distance__m((latitude, longitude), self.posts[post_key]['start'])
+            if distance <= radius__m:
+                ret.append((distance, post_key))
+
+        if routes:
+            found = set(k for (d, k) in ret)
+            for cell in _cells(query, ROUTE_CELL__DEG):
+                for post_key in self.routes.get(cell, ()):
+                    if post_key not in found and _intersects(query, self.posts[post_key]['bbox']):
+                        found.add(post_key)
+                        ret.append((distance__m((latitude, longitude), self.posts[post_key]['start']), post_key))
+
+        return sorted(ret)
+
+    def related(self, post_key):
+        """
+        Find posts on the same route: Starting nearby with a similar route bbox
+        :param post_key: e.g. "20201231-172153"
+        :return: List with tuples (overlap, post key), most similar first
+        """
+        if post_key not in self.posts:
+            return []
+
+        entry = self.posts[post_key]
+        ret = []
+        for (distance, key) in self.nearby(entry['start'][0], entry['start'][1], RELATED_START__M):
+            overlap = bbox_overlap(entry['bbox'], self.posts[key]['bbox'])
+            if key != post_key and overlap >= MIN_RELATED_OVERLAP:
+                ret.append((overlap, key))
+
+        ret.sort(key=lambda r: (-r[0], r[1]))
+        return ret[:MAX_RELATED]
+
+    def write_related(self, post_key):
+        """
+        Write the related routes of a post into its directory
+        :param post_key: e.g. "20201231-172153"
+        """
+        if post_key not in self.posts:
+            return
+
+        entries = []
+        for (overlap, key) in self.related(post_key):
+            related = self.posts[key]
+            entries.append({
+                'post': key,
+                'path': "post/" + related['path'],
+                'title': related['title'],
+                'date': related['date'],
+                'overlap': round(overlap, 2),
+            })
+
+        file = os.path.join(posts_dir, self.posts[post_key]['path'], related_file_name)
+        if len(entries) == 0:
+            if os.path.exists(file):
+                os.remove(file)
+            return
+
+        with open(file, "w") as f:
+            json.dump(entries, f, indent=2)
+
+    def save(self):
+        debug(f"Saving {len(self.posts)} positions to {spatial_file}, related routes of {len(self.changed)} posts")
+        for post_key in sorted(self.changed):
+            self.write_related(post_key)
+        self.changed = set()
+
+        os.makedirs(index_dir, exist_ok=True)
+        with open(spatial_file, "w") as f:
+            json.dump(self.posts, f, sort_keys=True)
+
+
+def read_spatial_index():
+    """
+    Read the persisted index. If there is none, it will be built once from the front matter of all existing posts
+    :return: SpatialIndex
+    """
+    if os.path.exists(spatial_file):
+        with open(spatial_file, "r") as f:
+            return SpatialIndex(json.load(f))
+
+    index = SpatialIndex(dict())
+    post_files = list_post_files()
+    if len(post_files) > 0:
+        out(f"Building spatial index for {len(post_files)} existing posts...")
+
+    missing = 0
+    for post_file in post_files:
+        post = read_post_file(post_file)
+        if Post.START_POSITION not in post.data:
+            missing += 1
+        index.add_post(post)
+
+    if missing > 0:
+        warn(f"{missing} posts without start position, e.g. without positions or created before. Try 'rebuild'.")
+
+    return index
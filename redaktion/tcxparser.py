@@ -4,22 +4,183 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import re
 import time
-from datetime import datetime
+from array import array
+from datetime import datetime, timezone
 
-from lxml import objectify
+import numpy as np
+from lxml import etree, objectify
 
-from utility import debug
+from utility import debug, convert_z_ended_date_to_dt
 
 namespace = 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2'
 
+_ns = '{%s}' % namespace
+TAG_ACTIVITY = _ns + 'Activity'
+TAG_ALTITUDE = _ns + 'AltitudeMeters'
+TAG_CADENCE = _ns + 'Cadence'
+TAG_CALORIES = _ns + 'Calories'
+TAG_DISTANCE = _ns + 'DistanceMeters'
+TAG_HEART_RATE = _ns + 'HeartRateBpm'
+TAG_LAP = _ns + 'Lap'
+TAG_LATITUDE = _ns + 'LatitudeDegrees'
+TAG_LONGITUDE = _ns + 'LongitudeDegrees'
+TAG_NOTES = _ns + 'Notes'
+TAG_POSITION = _ns + 'Position'
+TAG_TIME = _ns + 'Time'
+TAG_TOTAL_TIME = _ns + 'TotalTimeSeconds'
+TAG_TRACK = _ns + 'Track'
+TAG_TRACKPOINT = _ns + 'Trackpoint'
+TAG_VALUE = _ns + 'Value'
+
+# Aligned trackpoint columns, see track()
+TRACK_COLUMNS = ('time', 'heart_rate', 'altitude', 'distance', 'latitude', 'longitude', 'cadence')
+_nan = float('nan')
+
+
+def open_tcx(tcx_file, streaming=False):
+    """
+    Create the parser for a TCX file
+    :param tcx_file: Path of the file as String
+    :param streaming: True for the bounded-memory StreamingTCXParser
+    :return: TCXParser or StreamingTCXParser
+    """
+    if streaming:
+        return StreamingTCXParser(tcx_file)
+
+    return TCXParser(tcx_file)
+
+
+def read_activities(tcx_file, streaming=False, split_file=None):
+    """
+    Read all activities of a TCX file in one pass, e.g. of a bulk export or the legs of a multisport session
+    :param tcx_file: Path of the file as String
+    :param streaming: True for bounded-memory StreamingTCXParsers, then only one Activity is kept at a time
+    :param split_file: Function (number of the Activity, starting with 1) -> path to write the Activity to as
+    standalone TCX file in the same pass or None to not write it. The file is complete when its parser is yielded.
+    :return: Generator of TCXParser or StreamingTCXParser, one per Activity in document order
+    """
+    if streaming:
+        return _stream_activities(tcx_file, split_file=split_file)
+
+    return _tree_activities(tcx_file, split_file)
+
+
+def _tree_activities(tcx_file, split_file):
+    root = objectify.parse(tcx_file).getroot()
+    for number, activity in enumerate(root.iter(TAG_ACTIVITY), 1):
+        target_file = split_file(number) if split_file is not None else None
+        if target_file is not None:
+            (head, tail, declarations) = _standalone(root.nsmap)
+            with open(target_file, "wb") as f:
+                f.write(head)
+                f.write(_strip_declarations(etree.tostring(activity, with_tail=False), declarations))
+                f.write(tail)
+
+        yield TCXParser(tcx_file, activity)
+
+
+# Start tag of an Activity element with any namespace prefix, but not of Activities or ActivityExtension
+_activity_start = re.compile(rb"<(?:[\w.-]+:)?Activity[\s/>]")
+
+
+def count_activities(tcx_file):
+    """
+    Count the Activity elements by scanning the raw bytes, which is much faster than parsing the file
+    :param tcx_file: Path of the file
+    :return: Number of activities
+    """
+    count = 0
+    tail = b""
+    with open(tcx_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            data = tail + chunk
+            # Matches within the tail have been counted with the previous chunk
+            count += sum(1 for m in _activity_start.finditer(data) if m.end() > len(tail))
+            tail = data[-64:]
+
+    return count
+
+
+def _standalone(nsmap):
+    """
+    Frame of a standalone TCX file with a single Activity
+    :param nsmap: Namespaces of the root element of the source file
+    :return: Tuple (bytes up to the Activities start tag, bytes from the Activities end tag on, list with the
+    namespace declarations of the root, see _strip_declarations())
+    """
+    marker = "ACTIVITY"
+    root = etree.Element(_ns + 'TrainingCenterDatabase', nsmap=nsmap)
+    etree.SubElement(root, _ns + 'Activities').text = marker
+    (head, _, tail) = etree.tostring(root).rpartition(marker.encode())
+    declarations = re.findall(rb' xmlns(?::[\w.-]+)?="[^"]*"', head[:head.index(b">")])
+
+    return b"<?xml version='1.0' encoding='UTF-8'?>\n" + head, tail, declarations
+
+
+def _start_tag(elem, declarations):
+    """
+    :param elem: lxml element
+    :param declarations: Namespace declarations of the root, see _standalone()
+    :return: Tuple (bytes with the start tag of the element with its attributes, bytes with its end tag)
+    """
+    text = _strip_declarations(etree.tostring(etree.Element(elem.tag, dict(elem.attrib), nsmap=elem.nsmap)),
+                               declarations)
+    return text[:-2] + b">", b"</" + re.match(rb"<([^\s/>]+)", text).group(1) + b">"
+
+
+def _strip_declarations(text, declarations):
+    """
+    :param text: bytes with a serialized element
+    :param declarations: List with namespace declarations to remove from its start tag, e.g. b' xmlns="..."'
+    :return: bytes
+    """
+    end = text.index(b">")
+    head = text[:end]
+    for declaration in declarations:
+        head = head.replace(declaration, b"", 1)
+
+    return head + text[end:]
+
+
+def read_trackpoint(trackpoint):
+    """
+    Values of a Trackpoint element
+    :param trackpoint: lxml element
+    :return: Tuple with floats in the order of TRACK_COLUMNS, NaN for a missing value. Time as UTC timestamp.
+    """
+    time = heart_rate = altitude = distance = latitude = longitude = cadence = _nan
+    for child in trackpoint.iterchildren():
+        tag = child.tag
+        if tag == TAG_TIME:
+            time = convert_z_ended_date_to_dt(child.text).timestamp()
+        elif tag == TAG_POSITION:
+            latitude = float(child.findtext(TAG_LATITUDE))
+            longitude = float(child.findtext(TAG_LONGITUDE))
+        elif tag == TAG_ALTITUDE:
+            altitude = float(child.text)
+        elif tag == TAG_DISTANCE:
+            distance = float(child.text)
+        elif tag == TAG_HEART_RATE:
+            heart_rate = float(child.findtext(TAG_VALUE))
+        elif tag == TAG_CADENCE:
+            cadence = float(child.text)
+
+    return time, heart_rate, altitude, distance, latitude, longitude, cadence
+
 
 class TCXParser:
 
-    def __init__(self, tcx_file):
-        tree = objectify.parse(tcx_file)
-        self.root = tree.getroot()
-        self.activity = self.root.Activities.Activity
+    def __init__(self, tcx_file, activity=None):
+        """
+        :param tcx_file: Path of the file
+        :param activity: Activity element of the already parsed file, default the first Activity of the file
+        """
+        if activity is None:
+            activity = next(objectify.parse(tcx_file).getroot().iter(TAG_ACTIVITY))
+        self.root = activity.getroottree().getroot()
+        self.activity = activity
 
     @property
     def has_hr(self):
@@ -30,25 +191,46 @@ class TCXParser:
         return len(self.distance_values()) > 0
 
     def hr_values(self):
-        return [int(x.text) for x in self.root.xpath('//ns:HeartRateBpm/ns:Value', namespaces={'ns': namespace})]
+        return [int(x.text) for x in self.activity.xpath('.//ns:HeartRateBpm/ns:Value', namespaces={'ns': namespace})]
 
     def altitude_points(self):
-        return [float(x.text) for x in self.root.xpath('//ns:AltitudeMeters', namespaces={'ns': namespace})]
+        return [float(x.text) for x in self.activity.xpath('.//ns:AltitudeMeters', namespaces={'ns': namespace})]
 
     def position_values(self):
         return [
             (float(pos.LatitudeDegrees.text),
              float(pos.LongitudeDegrees.text))
-            for pos in self.root.xpath('//ns:Trackpoint/ns:Position', namespaces={'ns': namespace})]
+            for pos in self.activity.xpath('.//ns:Trackpoint/ns:Position', namespaces={'ns': namespace})]
+
+    def latitude_values(self):
+        return [lat for (lat, lon) in self.position_values()]
+
+    def longitude_values(self):
+        return [lon for (lat, lon) in self.position_values()]
 
     def distance_values(self):
-        return self.root.findall('.//ns:Trackpoint/ns:DistanceMeters', namespaces={'ns': namespace})
+        return self.activity.findall('.//ns:Trackpoint/ns:DistanceMeters', namespaces={'ns': namespace})
 
     def time_values(self):
-        return [x.text for x in self.root.xpath('//ns:Time', namespaces={'ns': namespace})]
+        return [x.text for x in self.activity.xpath('.//ns:Time', namespaces={'ns': namespace})]
+
+    def time_seconds(self):
+        """
+        :return: List with the trackpoint times as UTC timestamps in seconds
+        """
+        return [convert_z_ended_date_to_dt(t).timestamp() for t in self.time_values()]
 
     def cadence_values(self):
-        return [int(x.text) for x in self.root.xpath('//ns:Cadence', namespaces={'ns': namespace})]
+        return [int(x.text) for x in self.activity.xpath('.//ns:Cadence', namespaces={'ns': namespace})]
+
+    def track(self):
+        """
+        Aligned trackpoint columns of the activity
+        :return: Dict with a numpy float array for each of TRACK_COLUMNS, NaN for missing values
+        """
+        rows = [read_trackpoint(tp) for tp in self.activity.iter(TAG_TRACKPOINT)]
+        columns = np.array(rows, dtype=float).reshape(-1, len(TRACK_COLUMNS))
+        return {name: columns[:, i] for i, name in enumerate(TRACK_COLUMNS)}
 
     def first_position(self):
         """
@@ -104,7 +286,12 @@ class TCXParser:
 
     @property
     def completed_at(self):
-        return self.activity.Lap[-1].Track.Trackpoint[-1].Time.pyval
+        """
+        Time of the last trackpoint, also if the last laps have no track (e.g. gym sessions or a trailing empty lap)
+        :return: Original datetime as String in Z-format or None, if the activity has no trackpoints
+        """
+        times = self.activity.xpath('.//ns:Trackpoint/ns:Time', namespaces={'ns': namespace})
+        return times[-1].text if len(times) > 0 else None
 
     @property
     def cadence_avg(self):
@@ -219,3 +406,217 @@ class TCXParser:
     def activity_notes(self):
         """Return contents of Activity/Notes field if it exists."""
         return getattr(self.activity, 'Notes', '')
+
+
+class StreamingTCXParser(TCXParser):
+    """
+    Bounded-memory variant of TCXParser for very large files (multi-day recordings). The file is read in one
+    pass with iterparse, every element is cleared as soon as it has been read and the trackpoint samples are
+    stored in compact arrays. The list-producing methods return arrays that are built once instead of new lists,
+    so peak memory is proportional to the retained columns, not to the XML tree.
+    Like the properties of TCXParser, only the first Activity is read. See read_activities() for all activities.
+    """
+
+    def __init__(self, tcx_file=None):
+        """
+        :param tcx_file: Path of the file, None for an empty parser to be filled by _stream_activities()
+        """
+        self._sport = None
+        self._started_at = None
+        self._completed_at = None
+        self._lap_cadence = None
+        self._notes = ''
+        self._duration = 0.0
+        self._calories = 0
+        # Aligned columns by name, see track()
+        self._columns = {name: array('d') for name in TRACK_COLUMNS}
+        # Columns without missing values by name
+        self._compact = dict()
+
+        if tcx_file is not None and next(_stream_activities(tcx_file, first=self), None) is None:
+            self._complete(tcx_file)
+
+    def _values(self, name, typecode):
+        """
+        Column without the missing values, built once
+        :param name: One of TRACK_COLUMNS
+        :param typecode: 'i' or 'd'
+        :return: array
+        """
+        if name not in self._compact:
+            column = self._columns[name]
+            column = column[~np.isnan(column)]
+            if typecode == 'i':
+                column = column.astype(np.intc)
+            self._compact[name] = array(typecode, column.tobytes())
+
+        return self._compact[name]
+
+    def _complete(self, tcx_file):
+        self._columns = {name: np.frombuffer(column, dtype=float) for name, column in self._columns.items()}
+        debug(f"Streamed {len(self._columns['time'])} trackpoints from {tcx_file}")
+
+    def track(self):
+        return self._columns
+
+    def hr_values(self):
+        return self._values('heart_rate', 'i')
+
+    def altitude_points(self):
+        return self._values('altitude', 'd')
+
+    def position_values(self):
+        """
+        Builds a new list of (lat, lon) tuples. Use latitude_values() and longitude_values() for large files.
+        """
+        return list(zip(self.latitude_values(), self.longitude_values()))
+
+    def latitude_values(self):
+        return self._values('latitude', 'd')
+
+    def longitude_values(self):
+        return self._values('longitude', 'd')
+
+    def distance_values(self):
+        return self._values('distance', 'd')
+
+    def time_values(self):
+        """
+        Builds a new list of Z-ended Strings. Use time_seconds() for large files.
+        """
+        return [datetime.fromtimestamp(t, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ") for t in self.time_seconds()]
+
+    def time_seconds(self):
+        """
+        :return: array with the trackpoint times as UTC timestamps in seconds
+        """
+        return self._values('time', 'd')
+
+    def cadence_values(self):
+        return self._values('cadence', 'i')
+
+    def first_position(self):
+        latitudes = self.latitude_values()
+        if len(latitudes) == 0:
+            return None
+        else:
+            return latitudes[0], self.longitude_values()[0]
+
+    @property
+    def activity_type(self):
+        return self._sport.lower()
+
+    @property
+    def started_at(self):
+        return self._started_at
+
+    @property
+    def completed_at(self):
+        return self._completed_at
+
+    @property
+    def cadence_avg(self):
+        return self._lap_cadence
+
+    @property
+    def duration(self):
+        return self._duration
+
+    @property
+    def calories(self):
+        return self._calories
+
+    @property
+    def activity_notes(self):
+        return self._notes
+
+
+def _stream_activities(tcx_file, first=None, split_file=None):
+    """
+    Read the Activity elements of a TCX file in one iterparse pass
+    :param tcx_file: Path of the file
+    :param first: StreamingTCXParser to fill with the first Activity, e.g. in its constructor
+    :param split_file: Function (number of the Activity) -> path to write the Activity to or None, see
+    read_activities(). The file is streamed as well, written elements are released like the read ones.
+    :return: Generator of StreamingTCXParser
+    """
+    containers = (TAG_ACTIVITY, TAG_LAP, TAG_TRACK)
+    parser = None
+    columns = None
+    number = 0
+    # Standalone file of the current Activity, its frame and the end tags of its open containers
+    target = None
+    frame = None
+    opened = []
+    for event, elem in etree.iterparse(tcx_file, events=('start', 'end'), huge_tree=True):
+        tag = elem.tag
+
+        if event == 'start':
+            if tag == TAG_ACTIVITY:
+                number += 1
+                parser = first if first is not None else StreamingTCXParser()
+                first = None
+                parser._sport = elem.get('Sport')
+                columns = [parser._columns[name] for name in TRACK_COLUMNS]
+                target_file = split_file(number) if split_file is not None else None
+                if target_file is not None:
+                    frame = _standalone(elem.getroottree().getroot().nsmap)
+                    target = open(target_file, "wb")
+                    target.write(frame[0])
+
+            elif tag == TAG_LAP and parser is not None:
+                if parser._started_at is None:
+                    parser._started_at = elem.get('StartTime')
+                # Like TCXParser, only the Cadence of the last Lap counts
+                parser._lap_cadence = None
+
+            if target is not None and tag in containers:
+                (start, end) = _start_tag(elem, frame[2])
+                target.write(start)
+                opened.append(end)
+            continue
+
+        if parser is None:
+            continue
+
+        if target is not None:
+            if tag in containers:
+                target.write(opened.pop())
+            elif elem.getparent().tag in containers:
+                target.write(_strip_declarations(etree.tostring(elem, with_tail=False), frame[2]))
+
+        if tag == TAG_TRACKPOINT:
+            for column, value in zip(columns, read_trackpoint(elem)):
+                column.append(value)
+            parser._completed_at = elem.findtext(TAG_TIME) or parser._completed_at
+            _release(elem)
+        elif tag == TAG_LAP:
+            _release(elem)
+        elif tag == TAG_ACTIVITY:
+            _release(elem)
+            parser._complete(tcx_file)
+            if target is not None:
+                target.write(frame[1])
+                target.close()
+                target = None
+            yield parser
+            parser = None
+        elif elem.getparent().tag == TAG_LAP:
+            if tag == TAG_TOTAL_TIME:
+                parser._duration += float(elem.text)
+            elif tag == TAG_CALORIES:
+                parser._calories += int(elem.text)
+            elif tag == TAG_CADENCE:
+                parser._lap_cadence = int(elem.text)
+        elif tag == TAG_NOTES and elem.getparent().tag == TAG_ACTIVITY:
+            parser._notes = elem.text or ''
+
+
+def _release(elem):
+    """
+    Free an element that has been read completely, including its already processed preceding siblings
+    :param elem: lxml element
+    """
+    elem.clear(keep_tail=True)
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
@@ -0,0 +1,125 @@
+import math
+import os
+
+import numpy as np
+
+from utility import debug
+
+thumbnail_file_name = "route.svg"
+
+# Size of the SVG viewBox and the free border around the route
+VIEW_SIZE = 100
+PADDING = 4
+
+# Simplification tolerance in viewBox units and the maximum number of points. The tolerance will be
+# doubled until the route has at most MAX_POINTS.
+TOLERANCE = 0.8
+MAX_POINTS = 60
+
+STROKE_COLOR = "#e0672b"
+
+
+def simplify(xs, ys, tolerance, zs=None):
+    """
+    Douglas-Peucker line simplification
+    :param xs: numpy array with x values
+    :param ys: numpy array with y values, same length as xs
+    :param tolerance: Maximum distance of a dropped point to the simplified line
+    :param zs: numpy array with z values, same length as xs, or None for a line in the plane
+    :return: numpy array with the indices of the kept points
+    """
+    if zs is None:
+        zs = np.zeros(len(xs))
+
+    keep = np.zeros(len(xs), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(xs) - 1)]
+    while stack:
+        (first, last) = stack.pop()
+        if last - first < 2:
+            continue
+
+        dx = xs[last] - xs[first]
+        dy = ys[last] - ys[first]
+        dz = zs[last] - zs[first]
+        px = xs[first + 1:last] - xs[first]
+        py = ys[first + 1:last] - ys[first]
+        pz = zs[first + 1:last] - zs[first]
+        length = math.hypot(math.hypot(dx, dy), dz)
+        if length == 0:
+            distances = np.hypot(np.hypot(px, py), pz)
+        else:
+            # Distance to the segment, not to the line, so the turning point of an out-and-back route is kept
+            t = np.clip((px * dx + py * dy + pz * dz) / length ** 2, 0, 1)
+            distances = np.hypot(np.hypot(px - t * dx, py - t * dy), pz - t * dz)
+
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance:
+            split = first + 1 + i
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+
+    return np.nonzero(keep)[0]
+
+
+def build_route_svg(latitudes, longitudes):
+    """
+    Project the track into a square viewBox, simplify it and render it as SVG polyline
+    :param latitudes: Sequence with floats
+    :param longitudes: Sequence with floats, same length as latitudes
+    :return: SVG document as String or None, if the track has less than two positions
+    """
+    if len(latitudes) < 2:
+        return None
+
+    lat = np.asarray(latitudes, dtype=float)
+    lon = np.asarray(longitudes, dtype=float)
+
+    # Equirectangular projection around the mean latitude, y grows downward in SVG
+    xs = lon * math.cos(math.radians(lat.mean()))
+    ys = -lat
+    xs -= xs.min()
+    ys -= ys.min()
+    extent = max(xs.max(), ys.max())
+    if extent == 0:
+        return None
+
+    scale = (VIEW_SIZE - 2 * PADDING) / extent
+    xs = xs * scale + PADDING + (VIEW_SIZE - 2 * PADDING - xs.max() * scale) / 2
+    ys = ys * scale + PADDING + (VIEW_SIZE - 2 * PADDING - ys.max() * scale) / 2
+
+    tolerance = TOLERANCE
+    kept = simplify(xs, ys, tolerance)
+    while len(kept) > MAX_POINTS:
+        tolerance *= 2
+        kept = simplify(xs, ys, tolerance)
+
+    points = " ".join(f"{round(xs[i])},{round(ys[i])}" for i in kept)
+
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {VIEW_SIZE} {VIEW_SIZE}">'
+            f'<polyline fill="none" stroke="{STROKE_COLOR}" stroke-width="3" stroke-linecap="round" '
+            f'stroke-linejoin="round" points="{points}"/></svg>\n')
+
+
+def write_route_thumbnail(post, tcxparser):
+    """
+    Write the route thumbnail into the post's directory. An outdated one will be removed, if the
+    activity has no track.
+    :param post: Post
+    :param tcxparser: TCXParser of the post's activity file
+    :return: True, if written
+    """
+    file = os.path.join(os.path.dirname(post.file_name), thumbnail_file_name)
+    svg = build_route_svg(tcxparser.latitude_values(), tcxparser.longitude_values())
+
+    if svg is None:
+        if os.path.exists(file):
+            os.remove(file)
+        return False
+
+    with open(file, "w") as f:
+        f.write(svg)
+
+    debug(f"Route thumbnail written with {len(svg)} bytes")
+    return True
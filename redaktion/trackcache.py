@@ -0,0 +1,208 @@
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from tcxparser import StreamingTCXParser, TRACK_COLUMNS, open_tcx
+from utility import debug
+
+track_cache_file_name = "track.cache"
+
+MAGIC = b"HTTRACK1"
+VERSION = 1
+
+# Fixed-point scale of the columns, e.g. altitude in mm and positions in 1e-7 degrees
+SCALES = {
+    'time': 1,
+    'heart_rate': 1,
+    'altitude': 1000,
+    'distance': 1000,
+    'latitude': 10000000,
+    'longitude': 10000000,
+    'cadence': 1,
+}
+
+_int_types = (np.int8, np.int16, np.int32, np.int64)
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+def _encode_column(values, scale):
+    """
+    Delta-encode a column in fixed point with the narrowest integer type the deltas fit in
+    :param values: numpy float array, NaN for missing values
+    :param scale: Fixed-point scale
+    :return: Tuple with column dict for the header, deltas bytes and mask bytes (empty, if no value is missing)
+    """
+    valid = ~np.isnan(values)
+    fixed = np.zeros(len(values), dtype=np.int64)
+    fixed[valid] = np.round(values[valid] * scale).astype(np.int64)
+    if not valid.all() and valid.any():
+        # Missing values repeat the previous value, so they don't widen the deltas
+        last_valid = np.maximum.accumulate(np.where(valid, np.arange(len(values)), 0))
+        first_valid = int(np.argmax(valid))
+        last_valid[:first_valid] = first_valid
+        fixed = fixed[last_valid]
+
+    first = int(fixed[0]) if len(fixed) > 0 else 0
+    deltas = np.diff(fixed, prepend=first)
+    dtype = _int_types[-1]
+    for t in _int_types:
+        info = np.iinfo(t)
+        if len(deltas) == 0 or (deltas.min() >= info.min and deltas.max() <= info.max):
+            dtype = t
+            break
+
+    mask = b"" if valid.all() else np.packbits(valid).tobytes()
+    column = {'scale': scale, 'first': first, 'dtype': np.dtype(dtype).str}
+
+    return column, deltas.astype(dtype).tobytes(), mask
+
+
+def write_track_cache(post, tcxparser):
+    """
+    Write the trackpoint columns and activity data of the post's activity into a compact binary file,
+    which can be read much faster than the TCX file
+    :param post: Post
+    :param tcxparser: TCXParser of the post's activity file
+    :return: Path of the written file
+    """
+    file = os.path.join(os.path.dirname(post.file_name), track_cache_file_name)
+    track = tcxparser.track()
+
+    header = {
+        'version': VERSION,
+        'count': len(track['time']),
+        'activity': {
+            'sport': tcxparser.activity_type,
+            'started_at': tcxparser.started_at,
+            'completed_at': tcxparser.completed_at,
+            'duration': float(tcxparser.duration),
+            'calories': int(tcxparser.calories),
+            'cadence_avg': _optional_int(tcxparser, 'cadence_avg'),
+            'notes': str(tcxparser.activity_notes),
+        },
+        'columns': dict(),
+    }
+
+    payloads = []
+    for name in TRACK_COLUMNS:
+        (column, deltas, mask) = _encode_column(track[name], SCALES[name])
+        header['columns'][name] = column
+        payloads.append((column, deltas, mask))
+
+    # Offsets are relative to the payload start, which is 8-byte aligned after the header
+    offset = 0
+    for (column, deltas, mask) in payloads:
+        column['offset'] = offset
+        offset = _align(offset + len(deltas))
+        column['mask_offset'] = offset if len(mask) > 0 else None
+        offset = _align(offset + len(mask))
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    payload_start = _align(len(MAGIC) + 4 + len(header_bytes))
+
+    with open(file, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b"\0" * (payload_start - f.tell()))
+        for (column, deltas, mask) in payloads:
+            f.write(deltas)
+            f.write(b"\0" * (payload_start + _align(f.tell() - payload_start) - f.tell()))
+            f.write(mask)
+            f.write(b"\0" * (payload_start + _align(f.tell() - payload_start) - f.tell()))
+
+    debug(f"Track cache written with {os.path.getsize(file)} bytes")
+    return file
+
+
+def _optional_int(tcxparser, name):
+    try:
+        value = getattr(tcxparser, name)
+    except AttributeError:
+        return None
+
+    return None if value is None else int(value)
+
+
+class TrackCacheParser(StreamingTCXParser):
+    """
+    TCXParser-compatible reader for a track cache file. The file is memory mapped and the columns are decoded
+    with a vectorized cumulative sum.
+    """
+
+    def __init__(self, cache_file):
+        with open(cache_file, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"Not a track cache file: {cache_file}")
+
+        (header_length,) = struct.unpack_from("<I", buffer, len(MAGIC))
+        header_start = len(MAGIC) + 4
+        header = json.loads(buffer[header_start:header_start + header_length].decode("utf-8"))
+        payload_start = _align(header_start + header_length)
+        count = header['count']
+
+        activity = header['activity']
+        self._sport = activity['sport']
+        self._started_at = activity['started_at']
+        self._completed_at = activity['completed_at']
+        self._lap_cadence = activity['cadence_avg']
+        self._notes = activity['notes']
+        self._duration = activity['duration']
+        self._calories = activity['calories']
+        self._compact = dict()
+
+        self._columns = dict()
+        for name in TRACK_COLUMNS:
+            column = header['columns'][name]
+            deltas = np.frombuffer(buffer, dtype=np.dtype(column['dtype']), count=count,
+                                   offset=payload_start + column['offset'])
+            values = (np.cumsum(deltas, dtype=np.int64) + column['first']) / column['scale']
+            if column['mask_offset'] is not None:
+                mask = np.frombuffer(buffer, dtype=np.uint8, count=(count + 7) // 8,
+                                     offset=payload_start + column['mask_offset'])
+                values[~np.unpackbits(mask, count=count).astype(bool)] = np.nan
+            self._columns[name] = values
+
+        debug(f"Read {count} trackpoints from {cache_file}")
+
+
+def is_track_cache_fresh(post):
+    """
+    :param post: Post
+    :return: True, if the post has a track cache which is newer than its activity file
+    """
+    cache_file = os.path.join(os.path.dirname(post.file_name), track_cache_file_name)
+    activity_file = post.get_activity_file()
+    if not os.path.exists(cache_file):
+        return False
+
+    if activity_file is None or not os.path.exists(activity_file):
+        return True
+
+    return os.path.getmtime(cache_file) >= os.path.getmtime(activity_file)
+
+
+def open_activity(post, stream=False, use_cache=True):
+    """
+    Create the parser for the post's activity, using the track cache as fast path if it is fresh
+    :param post: Post
+    :param stream: True to use the bounded-memory StreamingTCXParser for the activity file
+    :param use_cache: False to ignore the track cache
+    :return: TCXParser compatible object or None, if the post has no activity file
+    """
+    if use_cache and is_track_cache_fresh(post):
+        return TrackCacheParser(os.path.join(os.path.dirname(post.file_name), track_cache_file_name))
+
+    activity_file = post.get_activity_file()
+    if activity_file is None or not os.path.exists(activity_file):
+        return None
+
+    return open_tcx(activity_file, stream)
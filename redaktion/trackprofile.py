@@ -0,0 +1,121 @@
+import json
+import os
+
+import numpy as np
+
+from utility import debug
+
+profile_file_name = "profile.json"
+
+# Number of points of each series after downsampling
+PROFILE_POINTS = 300
+
+# Speed is measured between the trackpoints this number before and after
+SPEED_WINDOW = 5
+
+# Decimals of the series values in the file
+DECIMALS = {'altitude__m': 1, 'heart_rate__bpm': 0, 'speed__km_per_h': 1}
+
+
+def lttb(xs, ys, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling. The buckets depend on each other and are walked in order, the
+    triangle areas of all points of a bucket are computed at once.
+    :param xs: numpy array with non-decreasing x values
+    :param ys: numpy array with y values, same length as xs
+    :param threshold: Number of points to keep
+    :return: numpy array with the indices of the kept points
+    """
+    count = len(xs)
+    if threshold >= count or threshold < 3:
+        return np.arange(count)
+
+    # threshold - 2 buckets between the first and the last point, each with at least one point
+    edges = np.linspace(1, count - 1, threshold - 1).astype(int)
+    ret = np.empty(threshold, dtype=int)
+    ret[0] = 0
+    ret[-1] = count - 1
+    a = 0
+    for i in range(threshold - 2):
+        (start, end) = (edges[i], edges[i + 1])
+        (next_start, next_end) = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (count - 1, count)
+        cx = xs[next_start:next_end].mean()
+        cy = ys[next_start:next_end].mean()
+        areas = np.abs((xs[a] - cx) * (ys[start:end] - ys[a]) - (xs[a] - xs[start:end]) * (cy - ys[a]))
+        a = start + int(np.argmax(areas))
+        ret[i + 1] = a
+
+    return ret
+
+
+def _speed(times, distances):
+    indices = np.arange(len(times))
+    before = np.maximum(indices - SPEED_WINDOW, 0)
+    after = np.minimum(indices + SPEED_WINDOW, len(times) - 1)
+    elapsed = times[after] - times[before]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(elapsed > 0, (distances[after] - distances[before]) / elapsed * 3.6, np.nan)
+
+
+def build_profile(tcxparser):
+    """
+    Elevation, heart rate and speed against distance, each downsampled to PROFILE_POINTS
+    :param tcxparser: TCXParser
+    :return: Dict with 'distance__m' and per series 'min', 'max' and 'points' as [distance, value] or None,
+    if the activity has no distances
+    """
+    track = tcxparser.track()
+    valid = ~np.isnan(track['distance']) & ~np.isnan(track['time'])
+    if valid.sum() < 2:
+        return None
+
+    distances = np.maximum.accumulate(track['distance'][valid])
+    series = {
+        'altitude__m': track['altitude'][valid],
+        'heart_rate__bpm': track['heart_rate'][valid],
+        'speed__km_per_h': _speed(track['time'][valid], distances),
+    }
+
+    ret = {'distance__m': int(distances[-1])}
+    for name, values in series.items():
+        present = ~np.isnan(values)
+        if present.sum() < 2:
+            continue
+
+        xs = distances[present]
+        ys = values[present]
+        kept = lttb(xs, ys, PROFILE_POINTS)
+        ys = np.round(ys[kept], DECIMALS[name])
+        if DECIMALS[name] == 0:
+            ys = ys.astype(int)
+
+        ret[name] = {
+            'min': ys.min().item(),
+            'max': ys.max().item(),
+            'points': [[x, y] for x, y in zip(np.round(xs[kept]).astype(int).tolist(), ys.tolist())],
+        }
+
+    return ret
+
+
+def write_profile(post, tcxparser):
+    """
+    Write the profile data into the post's directory. An outdated one will be removed, if the activity has
+    no distances.
+    :param post: Post
+    :param tcxparser: TCXParser of the post's activity file
+    :return: True, if written
+    """
+    file = os.path.join(os.path.dirname(post.file_name), profile_file_name)
+    profile = build_profile(tcxparser)
+
+    if profile is None:
+        if os.path.exists(file):
+            os.remove(file)
+        return False
+
+    with open(file, "w") as f:
+        json.dump(profile, f, separators=(',', ':'))
+
+    debug(f"Profile written with {os.path.getsize(file)} bytes")
+    return True
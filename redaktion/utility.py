@@ -8,6 +8,9 @@ log_switch = False
 out_file = 'out.txt'
 posts_dir = "../content/post"
 devices_dir = "../content/devices"
+index_dir = "index"
+data_dir = "../data"
+static_dir = "../static"
 device_file_name = "_index.md"
 post_file_name = "index.md"
 
@@ -77,16 +80,17 @@ def z_date_to_utc_date(utc_datetime_z_string):
     return ret
 
 
-def build_post_path(post_datetime):
+def build_post_path(post_datetime, root=posts_dir):
     """
     Build the path to the post directory for a given timestamp (==ID)
     :param post_datetime: A datetime object
+    :param root: Directory of the posts, e.g. of a shard
     :return: String with the path to the directory, e.g. "/hugo/content/post/2020/20203112-105959
     """
     post_dir = build_post_key(post_datetime)
     year = datetime.datetime.strftime(post_datetime, "%Y")
 
-    return os.path.join(posts_dir, year, post_dir)
+    return os.path.join(root, year, post_dir)
 
 
 def build_post_key(post_datetime):